@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 
-import ctypes, enum, fcntl, mmap, os, os.path, time
+import asyncio, collections, ctypes, enum, errno, fcntl, hashlib, json, marshal, mmap, os, os.path, struct, sys, tempfile, threading, time, weakref
 
 IOC_NONE = 0
 IOC_WRITE = 1
@@ -12,9 +12,12 @@ IOC_TYPE_SHIFT = 8
 IOC_NR_SHIFT = 0
 
 def set_bits(x, num_bits):
-    for bit in range(0, num_bits):
-        if x & (1 << bit):
-            yield bit
+    x &= (1 << num_bits) - 1
+
+    while x:
+        bit = (x & -x).bit_length() - 1
+        x &= x - 1
+        yield bit
 
 def _IOC(dir, type, nr, size):
     return dir << IOC_DIR_SHIFT | size << IOC_SIZE_SHIFT | type << IOC_TYPE_SHIFT | nr << IOC_NR_SHIFT
@@ -37,6 +40,9 @@ class Error(Exception):
 class DeprecatedError(Error):
     pass
 
+class NotFound(Error):
+    pass
+
 class version(ctypes.Structure):
     _fields_ = [
         ('version_major', ctypes.c_int),
@@ -108,78 +114,154 @@ class mode_info(ctypes.Structure):
     def __str__(self):
         return '%ux%u-%u' % (self.hdisplay, self.vdisplay, self.vrefresh)
 
+    flag_names = [
+        (MODE_FLAG_PHSYNC, 'phsync'),
+        (MODE_FLAG_NHSYNC, 'nhsync'),
+        (MODE_FLAG_PVSYNC, 'pvsync'),
+        (MODE_FLAG_NVSYNC, 'nvsync'),
+        (MODE_FLAG_INTERLACE, 'interlace'),
+        (MODE_FLAG_DBLSCAN, 'dblscan'),
+        (MODE_FLAG_CSYNC, 'csync'),
+        (MODE_FLAG_PCSYNC, 'pcsync'),
+        (MODE_FLAG_NCSYNC, 'ncsync'),
+        (MODE_FLAG_HSKEW, 'hskew'),
+        (MODE_FLAG_BCAST, 'bcast'),
+        (MODE_FLAG_PIXMUX, 'pixmux'),
+        (MODE_FLAG_DBLCLK, 'dblclk'),
+        (MODE_FLAG_CLKDIV2, 'clkdiv2'),
+    ]
+
+    type_names = [
+        (MODE_TYPE_BUILTIN, 'builtin'),
+        (MODE_TYPE_CLOCK_C, 'clock-c'),
+        (MODE_TYPE_CRTC_C, 'crtc-c'),
+        (MODE_TYPE_PREFERRED, 'preferred'),
+        (MODE_TYPE_DEFAULT, 'default'),
+        (MODE_TYPE_USERDEF, 'userdef'),
+        (MODE_TYPE_DRIVER, 'driver'),
+    ]
+
+    # decoded name lists, keyed by value; monitors share only a handful
+    names = {}
+
+    @staticmethod
+    def decode(table, value):
+        key = (id(table), value)
+        names = mode_info.names.get(key)
+
+        if names is None:
+            names = tuple(name for bit, name in table if value & bit)
+            mode_info.names[key] = names
+
+        return list(names)
+
     def get_flags(self):
-        flags = []
+        return mode_info.decode(mode_info.flag_names, self.flags)
+
+    def get_types(self):
+        return mode_info.decode(mode_info.type_names, self.type)
+
+# Modes reported by GETCONNECTOR, kept in the buffer that the kernel filled
+# in. Indexing returns mode_info structures that alias this buffer and the
+# queries operate on all modes at once through a NumPy structured array.
+class ModeTable:
+    def __init__(self, modes, count):
+        self.modes = modes
+        self.count = count
+
+    @staticmethod
+    def dtype(numpy):
+        names = [name for name, _ in mode_info._fields_]
+        formats = ['<u%u' % ctypes.sizeof(ctype) for _, ctype in mode_info._fields_[:-1]]
+        offsets = [getattr(mode_info, name).offset for name in names]
+
+        return numpy.dtype({ 'names': names, 'formats': formats + [ 'S32' ],
+                             'offsets': offsets,
+                             'itemsize': ctypes.sizeof(mode_info) })
+
+    @property
+    def array(self):
+        array = self.__dict__.get('_array')
 
-        if self.flags & MODE_FLAG_PHSYNC:
-            flags.append('phsync')
+        if array is None:
+            import numpy
 
-        if self.flags & MODE_FLAG_NHSYNC:
-            flags.append('nhsync')
+            dtype = ModeTable.dtype(numpy)
+            array = numpy.frombuffer(self.modes, dtype = dtype, count = self.count)
+            self._array = array
 
-        if self.flags & MODE_FLAG_PVSYNC:
-            flags.append('pvsync')
+        return array
 
-        if self.flags & MODE_FLAG_NVSYNC:
-            flags.append('nvsync')
+    def __len__(self):
+        return self.count
 
-        if self.flags & MODE_FLAG_INTERLACE:
-            flags.append('interlace')
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.modes[i] for i in range(*index.indices(self.count))]
 
-        if self.flags & MODE_FLAG_DBLSCAN:
-            flags.append('dblscan')
+        if index < 0:
+            index += self.count
 
-        if self.flags & MODE_FLAG_CSYNC:
-            flags.append('csync')
+        if index < 0 or index >= self.count:
+            raise IndexError('mode index out of range')
 
-        if self.flags & MODE_FLAG_PCSYNC:
-            flags.append('pcsync')
+        return self.modes[index]
 
-        if self.flags & MODE_FLAG_NCSYNC:
-            flags.append('ncsync')
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.modes[index]
 
-        if self.flags & MODE_FLAG_HSKEW:
-            flags.append('hskew')
+    def preferred(self):
+        import numpy
 
-        if self.flags & MODE_FLAG_BCAST:
-            flags.append('bcast')
+        matches = numpy.flatnonzero(self.array['type'] & MODE_TYPE_PREFERRED)
 
-        if self.flags & MODE_FLAG_PIXMUX:
-            flags.append('pixmux')
+        if len(matches) == 0:
+            return None
 
-        if self.flags & MODE_FLAG_DBLCLK:
-            flags.append('dblclk')
+        return self.modes[matches[0]]
 
-        if self.flags & MODE_FLAG_CLKDIV2:
-            flags.append('clkdiv2')
+    def best(self, width, height):
+        import numpy
 
-        return flags
+        array = self.array
+        matches = numpy.flatnonzero((array['hdisplay'] == width) &
+                                    (array['vdisplay'] == height))
 
-    def get_types(self):
-        types = []
+        if len(matches) == 0:
+            return None
 
-        if self.type & MODE_TYPE_BUILTIN:
-            types.append('builtin')
+        # highest refresh rate, pixel clock breaks ties
+        refresh = array['vrefresh'][matches].astype(numpy.uint64) << 32
+        index = numpy.argmax(refresh | array['clock'][matches])
 
-        if self.type & MODE_TYPE_CLOCK_C:
-            types.append('clock-c')
+        return self.modes[matches[index]]
 
-        if self.type & MODE_TYPE_CRTC_C:
-            types.append('crtc-c')
+    def filter(self, min_clock = 0, max_clock = None, flags = 0, exclude = 0,
+               types = 0):
+        array = self.array
 
-        if self.type & MODE_TYPE_PREFERRED:
-            types.append('preferred')
+        mask = array['clock'] >= min_clock
 
-        if self.type & MODE_TYPE_DEFAULT:
-            types.append('default')
+        if max_clock is not None:
+            mask &= array['clock'] <= max_clock
 
-        if self.type & MODE_TYPE_USERDEF:
-            types.append('userdef')
+        if flags:
+            mask &= (array['flags'] & flags) == flags
 
-        if self.type & MODE_TYPE_DRIVER:
-            types.append('driver')
+        if exclude:
+            mask &= (array['flags'] & exclude) == 0
 
-        return types
+        if types:
+            mask &= (array['type'] & types) == types
+
+        selected = array[mask]
+
+        modes = (mode_info * max(len(selected), 1))()
+        table = ModeTable(modes, len(selected))
+        table.array[:] = selected
+
+        return table
 
 class Capability(enum.IntEnum):
     DUMB_BUFFER = 0x1
@@ -353,7 +435,7 @@ class mode_fb_cmd2(ctypes.Structure):
             ('handles', ctypes.c_uint32 * 4),
             ('pitches', ctypes.c_uint32 * 4),
             ('offsets', ctypes.c_uint32 * 4),
-            ('modifier', ctypes.c_uint32 * 4)
+            ('modifier', ctypes.c_uint64 * 4)
         ]
 
 class mode_property_enum(ctypes.Structure):
@@ -402,6 +484,30 @@ class mode_get_blob(ctypes.Structure):
         ('data', ctypes.POINTER(ctypes.c_byte))
     ]
 
+class mode_atomic(ctypes.Structure):
+    _fields_ = [
+        ('flags', ctypes.c_uint32),
+        ('count_objs', ctypes.c_uint32),
+        ('objs_ptr', ctypes.c_uint64),
+        ('count_props_ptr', ctypes.c_uint64),
+        ('props_ptr', ctypes.c_uint64),
+        ('prop_values_ptr', ctypes.c_uint64),
+        ('reserved', ctypes.c_uint64),
+        ('user_data', ctypes.c_uint64)
+    ]
+
+class mode_create_blob(ctypes.Structure):
+    _fields_ = [
+        ('data', ctypes.c_uint64),
+        ('length', ctypes.c_uint32),
+        ('blob_id', ctypes.c_uint32)
+    ]
+
+class mode_destroy_blob(ctypes.Structure):
+    _fields_ = [
+        ('blob_id', ctypes.c_uint32)
+    ]
+
 class mode_crtc(ctypes.Structure):
     _fields_ = [
         ('set_connectors_ptr', ctypes.POINTER(ctypes.c_uint32)),
@@ -415,6 +521,51 @@ class mode_crtc(ctypes.Structure):
         ('mode', mode_info)
     ]
 
+class mode_crtc_page_flip(ctypes.Structure):
+    _fields_ = [
+        ('crtc_id', ctypes.c_uint32),
+        ('fb_id', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('sequence', ctypes.c_uint32),
+        ('user_data', ctypes.c_uint64)
+    ]
+
+class crtc_queue_sequence(ctypes.Structure):
+    _fields_ = [
+        ('crtc_id', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('sequence', ctypes.c_uint64),
+        ('user_data', ctypes.c_uint64)
+    ]
+
+EVENT_VBLANK = 0x01
+EVENT_FLIP_COMPLETE = 0x02
+EVENT_CRTC_SEQUENCE = 0x03
+
+class event(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('length', ctypes.c_uint32)
+    ]
+
+class event_vblank(ctypes.Structure):
+    _fields_ = [
+        ('base', event),
+        ('user_data', ctypes.c_uint64),
+        ('tv_sec', ctypes.c_uint32),
+        ('tv_usec', ctypes.c_uint32),
+        ('sequence', ctypes.c_uint32),
+        ('crtc_id', ctypes.c_uint32)
+    ]
+
+class event_crtc_sequence(ctypes.Structure):
+    _fields_ = [
+        ('base', event),
+        ('user_data', ctypes.c_uint64),
+        ('time_ns', ctypes.c_int64),
+        ('sequence', ctypes.c_uint64)
+    ]
+
 IOCTL_BASE = ord('d')
 COMMAND_BASE = 0x40
 
@@ -435,12 +586,15 @@ IOCTL_SET_MASTER = IO(0x1e)
 IOCTL_DROP_MASTER = IO(0x1f)
 IOCTL_PRIME_HANDLE_TO_FD = IOWR(0x2d, prime_handle)
 IOCTL_PRIME_FD_TO_HANDLE = IOWR(0x2e, prime_handle)
+IOCTL_CRTC_QUEUE_SEQUENCE = IOWR(0x3c, crtc_queue_sequence)
 IOCTL_MODE_GETRESOURCES = IOWR(0xa0, mode_resources)
 IOCTL_MODE_GETCRTC = IOWR(0xa1, mode_crtc)
 IOCTL_MODE_GETENCODER = IOWR(0xa6, mode_get_encoder)
 IOCTL_MODE_GETCONNECTOR = IOWR(0xa7, mode_get_connector)
 IOCTL_MODE_GETPROPERTY = IOWR(0xaa, mode_get_property)
 IOCTL_MODE_GETPROPBLOB = IOWR(0xac, mode_get_blob)
+IOCTL_MODE_RMFB = IOWR(0xaf, ctypes.c_uint)
+IOCTL_MODE_PAGE_FLIP = IOWR(0xb0, mode_crtc_page_flip)
 IOCTL_MODE_CREATE_DUMB = IOWR(0xb2, mode_create_dumb)
 IOCTL_MODE_MAP_DUMB = IOWR(0xb3, mode_map_dumb)
 IOCTL_MODE_DESTROY_DUMB = IOWR(0xb4, mode_destroy_dumb)
@@ -449,6 +603,9 @@ IOCTL_MODE_GETPLANE = IOWR(0xb6, mode_get_plane)
 IOCTL_MODE_SETPLANE = IOWR(0xb7, mode_set_plane)
 IOCTL_MODE_ADDFB2 = IOWR(0xb8, mode_fb_cmd2)
 IOCTL_MODE_OBJ_GETPROPERTIES = IOWR(0xb9, mode_obj_get_properties)
+IOCTL_MODE_ATOMIC = IOWR(0xbc, mode_atomic)
+IOCTL_MODE_CREATEPROPBLOB = IOWR(0xbd, mode_create_blob)
+IOCTL_MODE_DESTROYPROPBLOB = IOWR(0xbe, mode_destroy_blob)
 
 def get_flags(value):
     flags = []
@@ -544,6 +701,85 @@ class Format(enum.IntEnum):
 
         raise Exception()
 
+    def pack(self, array):
+        import numpy
+
+        if not isinstance(self.components, RGBA):
+            raise Error('format %s has no RGBA components' % self.name)
+
+        array = numpy.asarray(array)
+
+        if array.shape[-1] != 4:
+            raise Error('expected RGBA array, got shape %s' % (array.shape,))
+
+        components = [self.components.red, self.components.green,
+                      self.components.blue, self.components.alpha]
+        value = numpy.zeros(array.shape[:-1], dtype = numpy.uint32)
+
+        for i, c in enumerate(components):
+            if c.width == 0:
+                continue
+
+            mask = (1 << c.width) - 1
+
+            if array.dtype == numpy.uint8:
+                v = array[..., i].astype(numpy.uint32)
+
+                if c.width < 8:
+                    v *= mask
+                    v //= 255
+            else:
+                v = (array[..., i] * mask).astype(numpy.uint32)
+
+            value |= (v & mask) << c.shift
+
+        return value.astype('<u%u' % self.cpp[0])
+
+    def unpack(self, buffer, dtype = None):
+        import numpy
+
+        if not isinstance(self.components, RGBA):
+            raise Error('format %s has no RGBA components' % self.name)
+
+        if dtype is None:
+            dtype = numpy.uint8
+
+        packed = numpy.dtype('<u%u' % self.cpp[0])
+
+        if isinstance(buffer, numpy.ndarray):
+            if buffer.dtype != packed:
+                buffer = numpy.ascontiguousarray(buffer).view(packed)
+
+                if buffer.shape[-1] == 1:
+                    buffer = buffer[..., 0]
+        else:
+            buffer = numpy.frombuffer(buffer, dtype = packed)
+
+        components = [self.components.red, self.components.green,
+                      self.components.blue, self.components.alpha]
+        value = buffer.astype(numpy.uint32)
+        result = numpy.empty(value.shape + (4,), dtype = dtype)
+        integer = numpy.issubdtype(result.dtype, numpy.integer)
+
+        for i, c in enumerate(components):
+            if c.width == 0:
+                result[..., i] = 255 if integer else 1.0
+                continue
+
+            mask = (1 << c.width) - 1
+            v = (value >> c.shift) & mask
+
+            if integer:
+                if c.width != 8:
+                    v *= 255
+                    v //= mask
+
+                result[..., i] = v
+            else:
+                result[..., i] = v / mask
+
+        return result
+
     C8       = ('C', '8', ' ', ' ', 1, [1, 0, 0], 1, 1)
     ABGR4444 = ('A', 'B', '1', '2', 1, [2, 0, 0], 1, 1, RGBA(Component( 0, 4), Component(4, 4), Component( 8, 4), Component(12, 4)))
     XRGB1555 = ('X', 'R', '1', '5', 1, [2, 0, 0], 1, 1, RGBA(Component(10, 5), Component(5, 5), Component( 0, 5), Component(15, 1)))
@@ -560,11 +796,258 @@ class Format(enum.IntEnum):
     XBGR8888 = ('X', 'B', '2', '4', 1, [4, 0, 0], 1, 1, RGBA(Component( 0, 8), Component(8, 8), Component(16, 8), Component(24, 8)))
     ARGB8888 = ('A', 'R', '2', '4', 1, [4, 0, 0], 1, 1, RGBA(Component(16, 8), Component(8, 8), Component( 0, 8), Component(24, 8)))
     ABGR8888 = ('A', 'B', '2', '4', 1, [4, 0, 0], 1, 1, RGBA(Component( 0, 8), Component(8, 8), Component(16, 8), Component(24, 8)))
-    YUYV     = ('Y', 'U', 'Y', 'V', 3, [1, 1, 1], 2, 2)
-    UYVY     = ('U', 'Y', 'V', 'Y', 3, [1, 1, 1], 2, 2)
+    YUYV     = ('Y', 'U', 'Y', 'V', 1, [2, 0, 0], 2, 1)
+    UYVY     = ('U', 'Y', 'V', 'Y', 1, [2, 0, 0], 2, 1)
     YUV420   = ('Y', 'U', '1', '2', 3, [1, 1, 1], 2, 2)
     YUV422   = ('Y', 'U', '1', '6', 3, [1, 1, 1], 2, 1)
 
+def _planes(buf, fmt, height, pitch):
+    if isinstance(buf, (list, tuple)):
+        if not isinstance(pitch, (list, tuple)):
+            pitch = [pitch] + [pitch // fmt.hsub] * (len(buf) - 1)
+
+        return [(b.map() if isinstance(b, DumbBuffer) else b, 0, p) for b, p in zip(buf, pitch)]
+
+    if isinstance(buf, DumbBuffer):
+        buf = buf.map()
+
+    # planes are stored back to back in a single buffer
+    planes = [(buf, 0, pitch)]
+    offset = pitch * height
+
+    for i in range(1, fmt.num_planes):
+        planes.append((buf, offset, pitch // fmt.hsub))
+        offset += (pitch // fmt.hsub) * (height // fmt.vsub)
+
+    return planes
+
+def _rows(numpy, plane, y, count, length, dtype = 'u1'):
+    buf, offset, pitch = plane
+    dtype = numpy.dtype(dtype)
+
+    return numpy.ndarray((count, length), dtype, buffer = buf, offset = offset + y * pitch,
+                         strides = (pitch, dtype.itemsize))
+
+def _subsample(numpy, x, hsub, vsub):
+    # sums of up to four 8-bit values fit into 16 bits
+    result = x[:, 0::hsub].astype(numpy.int16)
+
+    # strided adds are much faster than a reduction over reshaped axes
+    for i in range(1, hsub):
+        result += x[:, i::hsub]
+
+    if vsub > 1:
+        result = sum(result[i::vsub] for i in range(vsub))
+
+    if hsub * vsub > 1:
+        result += (hsub * vsub) // 2
+        result >>= (hsub * vsub).bit_length() - 1
+
+    return result
+
+# Add a chroma term to each pixel it covers. Adding one horizontal phase at a
+# time is much faster than broadcasting over the short innermost axis.
+def _add_chroma(numpy, c, term, hsub):
+    x = numpy.empty(c.shape, dtype = numpy.int32)
+
+    for i in range(hsub):
+        numpy.add(c[..., i], term[:, None, :], out = x[..., i])
+
+    return x
+
+def _yuv_to_argb(numpy, luma, u, v, hsub, vsub):
+    # ITU-R BT.601, limited range, 8.8 fixed point: 298 * (Y - 16) + 128
+    count, width = luma.shape
+
+    c = numpy.multiply(luma, 298, dtype = numpy.int32)
+    c -= 16 * 298 - 128
+    c = c.reshape(count // vsub, vsub, width // hsub, hsub)
+
+    d = u.astype(numpy.int32)
+    d -= 128
+    e = v.astype(numpy.int32)
+    e -= 128
+
+    # Chroma terms are computed at chroma resolution and broadcast. Clamping
+    # in 8.8 fixed point leaves each channel in bits 8-15, from where a single
+    # shift or mask moves it into place.
+    blue = _add_chroma(numpy, c, 516 * d, hsub)
+    numpy.clip(blue, 0, 0xffff, out = blue)
+    blue >>= 8
+
+    value = blue.view(numpy.uint32)
+    value |= 0xff000000
+
+    green = _add_chroma(numpy, c, -100 * d - 208 * e, hsub)
+    numpy.clip(green, 0, 0xffff, out = green)
+    green &= 0xff00
+    value |= green.view(numpy.uint32)
+
+    red = _add_chroma(numpy, c, 409 * e, hsub)
+    numpy.clip(red, 0, 0xffff, out = red)
+    red &= 0xff00
+    red <<= 8
+    value |= red.view(numpy.uint32)
+
+    return value.reshape(count, width)
+
+def _argb_to_yuv(numpy, value, hsub, vsub):
+    # 8-bit channels of the little-endian ARGB8888 values
+    channels = value.view(numpy.uint8).reshape(value.shape + (4,))
+    r, g, b = channels[..., 2], channels[..., 1], channels[..., 0]
+
+    # luma fits into 16 bits unsigned, chroma into 16 bits signed
+    luma = numpy.multiply(r, 66, dtype = numpy.uint16)
+    luma += numpy.multiply(g, 129, dtype = numpy.uint16)
+    luma += numpy.multiply(b, 25, dtype = numpy.uint16)
+    luma += 128
+    luma >>= 8
+    luma += 16
+
+    # average each block of pixels before computing its chroma
+    r = _subsample(numpy, r, hsub, vsub)
+    g = _subsample(numpy, g, hsub, vsub)
+    b = _subsample(numpy, b, hsub, vsub)
+
+    u = -38 * r - 74 * g + 112 * b + 128
+    u >>= 8
+    u += 128
+
+    v = 112 * r - 94 * g - 18 * b + 128
+    v >>= 8
+    v += 128
+
+    return luma.astype(numpy.uint8), u.astype(numpy.uint8), v.astype(numpy.uint8)
+
+def _repack(numpy, src_fmt, dst_fmt, value):
+    src = src_fmt.components
+    dst = dst_fmt.components
+    src = [src.red, src.green, src.blue, src.alpha]
+    dst = [dst.red, dst.green, dst.blue, dst.alpha]
+
+    if [(c.shift, c.width) for c in src] == [(c.shift, c.width) for c in dst]:
+        return value
+
+    value = value.astype(numpy.uint32)
+    result = numpy.zeros(value.shape, dtype = numpy.uint32)
+
+    for s, d in zip(src, dst):
+        if d.width == 0:
+            continue
+
+        if s.width == 0:
+            result |= ((1 << d.width) - 1) << d.shift
+            continue
+
+        x = value >> s.shift
+        x &= (1 << s.width) - 1
+
+        if d.width < s.width:
+            x >>= s.width - d.width
+        elif d.width > s.width:
+            x *= (1 << d.width) - 1
+            x //= (1 << s.width) - 1
+
+        x <<= d.shift
+        result |= x
+
+    return result
+
+def _decode(numpy, fmt, planes, y, count, width):
+    if isinstance(fmt.components, RGBA):
+        return fmt, _rows(numpy, planes[0], y, count, width, '<u%u' % fmt.cpp[0])
+
+    if fmt == Format.YUYV or fmt == Format.UYVY:
+        data = _rows(numpy, planes[0], y, count, width * 2).reshape(count, width // 2, 4)
+
+        if fmt == Format.YUYV:
+            luma = data[..., 0::2]
+            u, v = data[..., 1], data[..., 3]
+        else:
+            luma = data[..., 1::2]
+            u, v = data[..., 0], data[..., 2]
+
+        value = _yuv_to_argb(numpy, luma.reshape(count, width), u, v, 2, 1)
+
+        return Format.ARGB8888, value
+
+    if fmt == Format.YUV420 or fmt == Format.YUV422:
+        cy, cc, cw = y // fmt.vsub, count // fmt.vsub, width // fmt.hsub
+
+        luma = _rows(numpy, planes[0], y, count, width)
+        u = _rows(numpy, planes[1], cy, cc, cw)
+        v = _rows(numpy, planes[2], cy, cc, cw)
+
+        return Format.ARGB8888, _yuv_to_argb(numpy, luma, u, v, fmt.hsub, fmt.vsub)
+
+    raise Error('conversion from %s not supported' % fmt.name)
+
+def _encode(numpy, fmt, planes, y, count, width, value_fmt, value):
+    if isinstance(fmt.components, RGBA):
+        rows = _rows(numpy, planes[0], y, count, width, '<u%u' % fmt.cpp[0])
+        rows[:] = _repack(numpy, value_fmt, fmt, value)
+        return
+
+    value = _repack(numpy, value_fmt, Format.ARGB8888, value).astype(numpy.uint32, copy = False)
+
+    if fmt == Format.YUYV or fmt == Format.UYVY:
+        luma, u, v = _argb_to_yuv(numpy, value, 2, 1)
+
+        data = _rows(numpy, planes[0], y, count, width * 2).reshape(count, width // 2, 4)
+        luma = luma.reshape(count, width // 2, 2)
+
+        if fmt == Format.YUYV:
+            data[..., 0::2] = luma
+            data[..., 1], data[..., 3] = u, v
+        else:
+            data[..., 1::2] = luma
+            data[..., 0], data[..., 2] = u, v
+
+        return
+
+    if fmt == Format.YUV420 or fmt == Format.YUV422:
+        luma, u, v = _argb_to_yuv(numpy, value, fmt.hsub, fmt.vsub)
+        cy, cc, cw = y // fmt.vsub, count // fmt.vsub, width // fmt.hsub
+
+        _rows(numpy, planes[0], y, count, width)[:] = luma
+        _rows(numpy, planes[1], cy, cc, cw)[:] = u
+        _rows(numpy, planes[2], cy, cc, cw)[:] = v
+
+        return
+
+    raise Error('conversion to %s not supported' % fmt.name)
+
+def convert(src_buf, src_fmt, dst_buf, dst_fmt, width, height, src_pitch, dst_pitch,
+            chunk_size = 1 << 20):
+    import numpy
+
+    for fmt in [src_fmt, dst_fmt]:
+        if width % fmt.hsub or height % fmt.vsub:
+            raise Error('%ux%u not a multiple of %s subsampling' % (width, height, fmt.name))
+
+    src = _planes(src_buf, src_fmt, height, src_pitch)
+    dst = _planes(dst_buf, dst_fmt, height, dst_pitch)
+
+    # Process as many rows at a time as fit into roughly chunk_size bytes of
+    # working set, so that intermediate results stay in cache. Each row needs
+    # the ARGB8888 intermediate and 32-bit temporaries besides the source and
+    # destination pixels. Chunks respect vertical subsampling.
+    step = max(src_fmt.vsub, dst_fmt.vsub)
+    row = width * (sum(src_fmt.cpp) + sum(dst_fmt.cpp) + 4 + 4)
+    chunk = max(chunk_size // row, step)
+    chunk -= chunk % step
+
+    for y in range(0, height, chunk):
+        count = min(chunk, height - y)
+
+        if src_fmt == dst_fmt and src_fmt.num_planes == 1:
+            length = width * src_fmt.cpp[0]
+            _rows(numpy, dst[0], y, count, length)[:] = _rows(numpy, src[0], y, count, length)
+            continue
+
+        value_fmt, value = _decode(numpy, src_fmt, src, y, count, width)
+        _encode(numpy, dst_fmt, dst, y, count, width, value_fmt, value)
+
 class Vendor(enum.IntEnum):
     NONE = 0
     INTEL = 1
@@ -615,6 +1098,90 @@ class Blob:
     def __str__(self):
         return '%u, %u bytes' % (self.id, len(self.data))
 
+class PropertyInfo:
+    def __init__(self, prop_id, name, flags, values, enums):
+        self.id = prop_id
+        self.name = name
+        self.flags = flags
+        self.flag_names = get_flags(flags)
+        self.values = values
+        self.enums = enums
+
+class BlobCache:
+    def __init__(self, max_size = 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+
+        # blob IDs in LRU order, mapping to the hash of their contents
+        self.blobs = collections.OrderedDict()
+        # identical payloads are only stored once
+        self.contents = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, blob_id, length):
+        digest = self.blobs.get(blob_id)
+
+        if digest is not None:
+            data = self.contents[digest][0]
+
+            # The blob ID has been reused for different contents. Callers must
+            # not rely on this, see Device.get_blob().
+            if len(data) == length:
+                self.blobs.move_to_end(blob_id)
+                self.hits += 1
+                return data
+
+            self.invalidate(blob_id)
+
+        self.misses += 1
+
+        return None
+
+    def insert(self, blob_id, data):
+        self.invalidate(blob_id)
+
+        digest = hashlib.sha256(data).digest()
+        entry = self.contents.get(digest)
+
+        if entry is None:
+            entry = self.contents[digest] = [data, 0]
+            self.size += len(data)
+
+        entry[1] += 1
+        self.blobs[blob_id] = digest
+
+        while self.size > self.max_size and len(self.blobs) > 1:
+            self.invalidate(next(iter(self.blobs)))
+
+        return entry[0]
+
+    def invalidate(self, blob_id):
+        digest = self.blobs.pop(blob_id, None)
+
+        if digest is not None:
+            entry = self.contents[digest]
+            entry[1] -= 1
+
+            if entry[1] == 0:
+                del self.contents[digest]
+                self.size -= len(entry[0])
+
+    def clear(self):
+        self.blobs.clear()
+        self.contents = {}
+        self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'blobs': len(self.blobs),
+            'contents': len(self.contents),
+            'size': self.size,
+        }
+
 class Property:
     def __init__(self, prop_id, name, flags):
         self.id = prop_id
@@ -641,11 +1208,24 @@ class PropertyRange(Property):
         return '%u: %s (range: %d < %d < %d)' % (self.id, self.name, self.min, self.value, self.max)
 
 class PropertyEnum(Property):
+    # enum types are shared by all objects exposing the same property
+    types = {}
+
     def __init__(self, prop_id, name, flags, enums, value):
         super().__init__(prop_id, name, flags)
 
-        self.type = enum.Enum(name, enums)
-        self.value = self.type(value)
+        key = (prop_id, name, tuple(enums.items()))
+        self.type = PropertyEnum.types.get(key)
+
+        if self.type is None:
+            self.type = enum.Enum(name, enums)
+            PropertyEnum.types[key] = self.type
+
+        # without any enum entries there is nothing to map the value to
+        if enums:
+            self.value = self.type(value)
+        else:
+            self.value = value
 
     def __str__(self):
         return '%u: %s (enum: %s)' % (self.id, self.name, self.type)
@@ -659,55 +1239,232 @@ class PropertyBlob(Property):
     def __str__(self):
         return '%u: %s (blob: %s)' % (self.id, self.name, self.blob)
 
+class PropertySignedRange(PropertyRange):
+    def __str__(self):
+        return '%u: %s (signed range: %d < %d < %d)' % (self.id, self.name, self.min, self.value, self.max)
+
 class PropertyBitmask(Property):
-    pass
+    def __init__(self, prop_id, name, flags, bits, value):
+        super().__init__(prop_id, name, flags)
+
+        self.bits = bits
+        self.value = value
+
+    def __str__(self):
+        names = [name for name, bit in self.bits.items() if self.value & (1 << bit)]
+        return '%u: %s (bitmask: %s)' % (self.id, self.name, ', '.join(names))
 
 class PropertyObject(Property):
-    pass
+    def __init__(self, prop_id, name, flags, obj_type, value):
+        super().__init__(prop_id, name, flags)
 
-    def __init__(self, device, prop_id, value):
-        self.device = device
-        self.id = prop_id
+        self.type = obj_type
         self.value = value
-        self.blob = None
-
-        self.name = args.name.decode('utf-8')
 
     def __str__(self):
-        return '%u: %s -> %u' % (self.id, self.name, self.value)
+        return '%u: %s (object: %u)' % (self.id, self.name, self.value)
 
 MODE_CONNECTED = 1
 MODE_DISCONNECTED = 2
 MODE_UNKNOWNCONNECTION = 3
 
 class Framebuffer:
-    def __init__(self, device, id):
+    def __init__(self, device, id, objects = None):
         self.device = device
         self.id = id
+        # keep buffer objects alive so that their handles can't be reused
+        self.objects = objects
+        self.owned = objects is not None
 
     def __repr__(self):
-        return '%u' % self.id
+        return '%s' % self.id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.owned and self.id is not None:
+            self.device.ioctl(IOCTL_MODE_RMFB, ctypes.c_uint(self.id))
+
+        self.objects = None
+        self.id = None
+
+# Cached framebuffers keep their buffer objects alive until they are evicted
+# or the buffer objects are closed. Evicting a framebuffer removes it (RMFB),
+# which disables any plane that is still scanning it out, so max_entries needs
+# to cover all framebuffers that can be on screen at the same time.
+class FramebufferCache:
+    def __init__(self, device, max_entries = 16):
+        self.device = device
+        self.max_entries = max_entries
+        self.framebuffers = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, width, height, pixel_format, flags, objects, pitches, offsets, modifiers):
+        if not isinstance(objects, list):
+            objects = [ objects ]
+
+        if not isinstance(pitches, list):
+            pitches = [ pitches ]
+
+        if not isinstance(offsets, list):
+            offsets = [ offsets ]
+
+        if not isinstance(modifiers, list):
+            modifiers = [ modifiers ]
+
+        # Handles are reused once a buffer object has been destroyed, so they
+        # only identify a buffer object together with the object itself. The
+        # cached framebuffer references the objects, so their id() is unique
+        # for as long as the entry exists.
+        key = (tuple((id(bo), bo.handle) for bo in objects), tuple(pitches),
+               tuple(offsets), tuple(modifiers), int(pixel_format), width, height, flags)
+
+        fb = self.framebuffers.get(key)
+
+        if fb is not None and fb.id is not None:
+            self.framebuffers.move_to_end(key)
+            self.hits += 1
+            return fb
+
+        self.misses += 1
+
+        fb = self.device.add_framebuffer(width, height, pixel_format, flags, objects,
+                                         pitches, offsets, modifiers)
+        self.framebuffers[key] = fb
+
+        while len(self.framebuffers) > self.max_entries:
+            key, old = self.framebuffers.popitem(last = False)
+            old.close()
+
+        return fb
+
+    def invalidate(self, bo):
+        for key, fb in list(self.framebuffers.items()):
+            if any(obj == id(bo) for obj, handle in key[0]):
+                del self.framebuffers[key]
+                fb.close()
+
+    def close(self):
+        for fb in self.framebuffers.values():
+            fb.close()
+
+        self.framebuffers.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'framebuffers': len(self.framebuffers),
+        }
+
+class LazyObject:
+    def __init__(self, lazy):
+        self.pending = set(['details', 'properties'])
+
+        if not lazy:
+            self.fetch()
+
+    def __getattr__(self, name):
+        pending = self.__dict__.get('pending')
+
+        # only reached for attributes that have not been fetched yet
+        if not pending or name.startswith('_'):
+            raise AttributeError(name)
+
+        if name == 'properties' and 'properties' in pending:
+            self.fetch_properties()
+        elif 'details' in pending:
+            self.fetch_details()
+        else:
+            raise AttributeError(name)
 
-class CRTC:
-    def __init__(self, device, index, crtc_id):
+        return getattr(self, name)
+
+    def fetch_details(self):
+        self.pending.discard('details')
+
+        try:
+            self.load()
+        except:
+            self.pending.add('details')
+            raise
+
+    def fetch_properties(self):
+        self.pending.discard('properties')
+
+        try:
+            self.properties = self.load_properties()
+        except:
+            self.pending.add('properties')
+            raise
+
+    def fetch(self):
+        if 'details' in self.pending:
+            self.fetch_details()
+
+        if 'properties' in self.pending:
+            self.fetch_properties()
+
+    def load_properties(self):
+        return self.device.decode_properties(self.property_values)
+
+    # drop decoded properties so that they are fetched again on next access
+    def reset_properties(self):
+        self.__dict__.pop('properties', None)
+        self.pending.add('properties')
+
+    # Snapshots only contain details that don't change without a hotplug.
+    # Current state, such as the CRTC of a plane or the property values, is
+    # left pending after a restore and fetched from the device on access.
+    def save(self):
+        self.fetch()
+
+        return self.save_details()
+
+    def restore(self, details):
+        self.restore_details(details)
+
+class CRTC(LazyObject):
+    def __init__(self, device, index, crtc_id, lazy = False):
         self.device = device
         self.index = index
         self.id = crtc_id
 
+        super().__init__(lazy)
+
+    def load(self):
         args = mode_crtc()
         args.crtc_id = self.id
 
-        device.ioctl(IOCTL_MODE_GETCRTC, args)
+        self.device.ioctl(IOCTL_MODE_GETCRTC, args)
 
         if args.mode_valid:
             self.mode = args.mode
         else:
             self.mode = None
 
+    def load_properties(self):
+        self.property_values = self.device.get_property_values(MODE_OBJECT_CRTC, self.id)
+
+        return super().load_properties()
+
+    # the mode is current state, so there is nothing to save
+    def save_details(self):
+        return None
+
+    def restore_details(self, details):
+        pass
+
     def __repr__(self):
         return '%u' % self.id
 
-class Connector:
+class Connector(LazyObject):
     class Status(enum.IntEnum):
         CONNECTED = 1
         DISCONNECTED = 2
@@ -742,64 +1499,113 @@ class Connector:
         SPI = (19, 'SPI')
         USB = (20, 'USB')
 
-    def __init__(self, device, connector_id):
+    def __init__(self, device, connector_id, probe = False, lazy = False):
         self.device = device
         self.id = connector_id
-        self.encoder = None
-
-        self.encoders = []
-        self.modes = []
-        self.properties = []
+        self.probed = probe
 
-        args = mode_get_connector()
-        args.connector_id = self.id
+        super().__init__(lazy)
 
-        device.ioctl(IOCTL_MODE_GETCONNECTOR, args)
+    def load(self):
+        self.update(self.probed)
 
-        if args.count_encoders > 0:
-            encoders = (ctypes.c_uint32 * args.count_encoders)()
-            args.encoders_ptr = encoders
+    # status, size and modes depend on the monitor, which is part of the
+    # snapshot key, while the active encoder is current state
+    def save_details(self):
+        modes = ctypes.string_at(self.modes.modes, len(self.modes) * ctypes.sizeof(mode_info))
+        encoders = [encoder.id for encoder in self.encoders]
 
-        if args.count_modes > 0:
-            modes = (mode_info * args.count_modes)()
-            args.modes_ptr = modes
+        return (self.name, int(self.status), self.width, self.height, encoders, modes)
 
-        if args.count_props > 0:
-            props = (ctypes.c_uint32 * args.count_props)()
-            prop_values = (ctypes.c_uint64 * args.count_props)()
+    def restore_details(self, details):
+        name, status, width, height, encoders, data = details
+        count = len(data) // ctypes.sizeof(mode_info)
 
-            args.props_ptr = props
-            args.prop_values_ptr = prop_values
+        self.name = name
+        self.status = Connector.Status(status)
+        self.width = width
+        self.height = height
+        self.encoders = [self.device.objects[encoder_id] for encoder_id in encoders]
+
+        modes = (mode_info * max(count, 1))()
+        ctypes.memmove(modes, data, len(data))
+        self.modes = ModeTable(modes, count)
+
+    def probe(self):
+        self.update(True)
+
+    def reset_properties(self):
+        super().reset_properties()
+
+        # the values are otherwise only refreshed along with the details
+        if 'details' not in self.pending:
+            self.property_values = self.device.get_property_values(MODE_OBJECT_CONNECTOR,
+                                                                   self.id)
+
+    def update(self, probe = False):
+        device = self.device
+
+        self.encoder = None
+        self.encoders = []
+
+        args = mode_get_connector()
+        args.connector_id = self.id
+
+        # passing a non-zero mode count returns the current state without probing
+        if not probe:
+            mode = mode_info()
+            args.count_modes = 1
+            args.modes_ptr = ctypes.pointer(mode)
 
         device.ioctl(IOCTL_MODE_GETCONNECTOR, args)
 
+        # retry if the connector changed between the two calls
+        while True:
+            encoders = (ctypes.c_uint32 * args.count_encoders)()
+            modes = (mode_info * max(args.count_modes, 1))()
+            props = (ctypes.c_uint32 * args.count_props)()
+            prop_values = (ctypes.c_uint64 * args.count_props)()
+
+            count_encoders = args.count_encoders
+            count_props = args.count_props
+
+            args.encoders_ptr = encoders
+            args.count_modes = len(modes)
+            args.modes_ptr = modes
+            args.props_ptr = props
+            args.prop_values_ptr = prop_values
+
+            device.ioctl(IOCTL_MODE_GETCONNECTOR, args)
+
+            if args.count_encoders <= count_encoders and \
+               args.count_modes <= len(modes) and \
+               args.count_props <= count_props:
+                break
+
         self.name = '%s-%u' % (Connector.Type(args.connector_type),
                                args.connector_type_id)
         self.status = Connector.Status(args.connection)
         self.width = args.mm_width
         self.height = args.mm_height
 
-        if args.count_encoders > 0:
-            for encoder_id in encoders:
-                for encoder in device.encoders:
-                    if encoder.id == encoder_id:
-                        self.encoders.append(encoder)
-                        break
-                else:
-                    raise NotFound('no encoder with ID %u' % encoder_id)
+        for encoder_id in encoders[:args.count_encoders]:
+            encoder = device.objects.get(encoder_id)
 
-        for encoder in self.encoders:
-            if encoder.id == args.encoder_id:
-                self.encoder = encoder
+            if encoder is None:
+                raise NotFound('no encoder with ID %u' % encoder_id)
 
-        if args.count_modes > 0:
-            for mode in modes:
-                self.modes.append(mode)
+            self.encoders.append(encoder)
 
-        if args.count_props > 0:
-            for prop_id, value in zip(props, prop_values):
-                prop = device.get_property(prop_id, value)
-                self.properties.append(prop)
+        if args.encoder_id in encoders[:args.count_encoders]:
+            self.encoder = device.objects[args.encoder_id]
+
+        self.modes = ModeTable(modes, args.count_modes)
+
+        # properties are decoded from the new values on next access
+        self.property_values = list(zip(props[:args.count_props], prop_values))
+        self.__dict__.pop('properties', None)
+        self.pending.discard('details')
+        self.pending.add('properties')
 
     def __str__(self):
         return '%u: %s (%ux%u mm, %s)' % (self.id, self.name, self.width,
@@ -818,7 +1624,7 @@ MODE_ENCODER_DSI = 6
 MODE_ENCODER_DPMST = 7
 MODE_ENCODER_DPI = 8
 
-class Encoder:
+class Encoder(LazyObject):
     types = {
         MODE_ENCODER_NONE: 'NONE',
         MODE_ENCODER_DAC: 'DAC',
@@ -831,98 +1637,97 @@ class Encoder:
         MODE_ENCODER_DPI: 'DPI',
     }
 
-    def __init__(self, device, index, id):
+    def __init__(self, device, index, id, lazy = False):
         self.device = device
         self.index = index
         self.id = id
 
+        super().__init__(lazy)
+
+    def load(self):
+        device = self.device
+
         args = mode_get_encoder()
-        args.encoder_id = id
+        args.encoder_id = self.id
 
         device.ioctl(IOCTL_MODE_GETENCODER, args)
 
         self.type = args.encoder_type
-        self.possible_crtcs = []
-        # need to resolve these later
-        self.possible_clones = args.possible_clones
-
-        for crtc in device.crtcs:
-            if crtc.id == args.crtc_id:
-                self.crtc = crtc
-                break
-        else:
-            self.crtc = None
-
-        for bit in set_bits(args.possible_crtcs, 32):
-            for crtc in device.crtcs:
-                if crtc.index == bit:
-                    self.possible_crtcs.append(crtc)
+        self.possible_crtcs = device.crtcs_from_mask(args.possible_crtcs)
+        self.possible_clones = device.encoders_from_mask(args.possible_clones)
+        self.crtc = device.objects.get(args.crtc_id)
 
         if args.encoder_type in Encoder.types:
             self.name = '%s' % Encoder.types[self.type]
         else:
             self.name = 'UNKNOWN'
 
+        # encoders have no properties
+        self.property_values = []
+
+    def save_details(self):
+        possible_crtcs = sum(1 << crtc.index for crtc in self.possible_crtcs)
+        possible_clones = sum(1 << encoder.index for encoder in self.possible_clones)
+
+        return self.type, possible_crtcs, possible_clones
+
+    def restore_details(self, details):
+        device = self.device
+
+        self.type, possible_crtcs, possible_clones = details
+        self.possible_crtcs = device.crtcs_from_mask(possible_crtcs)
+        self.possible_clones = device.encoders_from_mask(possible_clones)
+        self.name = Encoder.types.get(self.type, 'UNKNOWN')
+
     def __str__(self):
         return '%u: %s' % (self.id, self.name)
 
     def __repr__(self):
         return '%u' % self.id
 
-class Plane:
-    def __init__(self, device, id):
+class Plane(LazyObject):
+    def __init__(self, device, id, lazy = False):
         self.device = device
         self.id = id
-        self.crtcs = []
+
+        super().__init__(lazy)
+
+    def load(self):
+        device = self.device
         self.formats = []
-        self.properties = []
 
         args = mode_get_plane()
-        args.plane_id = id
+        args.plane_id = self.id
 
         device.ioctl(IOCTL_MODE_GETPLANE, args)
 
-        if args.count_format_types > 0:
-            formats = (ctypes.c_uint32 * args.count_format_types)()
-            args.format_type_ptr = formats
+        formats = (ctypes.c_uint32 * args.count_format_types)()
+        args.format_type_ptr = formats
 
         device.ioctl(IOCTL_MODE_GETPLANE, args)
 
-        for bit in set_bits(args.possible_crtcs, 32):
-            for crtc in device.crtcs:
-                if crtc.index == bit:
-                    self.crtcs.append(crtc)
-
-        for crtc in self.crtcs:
-            if crtc.id == args.crtc_id:
-                self.crtc = crtc
-                break
-        else:
-            self.crtc = None
+        self.crtcs = device.crtcs_from_mask(args.possible_crtcs)
+        self.crtc = device.objects.get(args.crtc_id)
 
         for fmt in formats:
             fmt = Format(fmt)
             self.formats.append(fmt)
 
-        args = mode_obj_get_properties()
-        args.obj_type = MODE_OBJECT_PLANE
-        args.obj_id = id
+    def load_properties(self):
+        self.property_values = self.device.get_property_values(MODE_OBJECT_PLANE, self.id)
 
-        device.ioctl(IOCTL_MODE_OBJ_GETPROPERTIES, args)
+        return super().load_properties()
 
-        if args.count_props > 0:
-            props = (ctypes.c_uint32 * args.count_props)()
-            args.props_ptr = props
+    def save_details(self):
+        possible_crtcs = sum(1 << crtc.index for crtc in self.crtcs)
 
-            values = (ctypes.c_uint64 * args.count_props)()
-            args.prop_values_ptr = values
+        return possible_crtcs, [int(fmt) for fmt in self.formats]
 
-        device.ioctl(IOCTL_MODE_OBJ_GETPROPERTIES, args)
+    def restore_details(self, details):
+        possible_crtcs, formats = details
 
-        if args.count_props > 0:
-            for prop, value in zip(props, values):
-                prop = device.get_property(prop, value)
-                self.properties.append(prop)
+        self.crtcs = self.device.crtcs_from_mask(possible_crtcs)
+        self.formats = [Format(fmt) for fmt in formats]
 
     def __repr__(self):
         return '%u' % self.id
@@ -953,10 +1758,15 @@ class GEM:
         self.size = size
 
 class DumbBuffer(GEM):
-    def __init__(self, device, width, height, handle, pitch, size):
+    mmap = None
+    handle = None
+
+    def __init__(self, device, width, height, bpp, handle, pitch, size):
         super().__init__(device, handle, size)
         self.width = width
         self.height = height
+        self.bpp = bpp
+        self.cpp = (bpp + 7) // 8
         self.pitch = pitch
         self.mmap = None
 
@@ -972,13 +1782,33 @@ class DumbBuffer(GEM):
         return self.mmap
 
     def __del__(self):
+        # errors can't be reported from here, e.g. if the device is gone
+        try:
+            self.close()
+        except OSError:
+            pass
+
+    def close(self):
         if self.mmap:
-            self.mmap.close()
+            try:
+                self.mmap.close()
+            except BufferError:
+                # arrays returned by as_array() still use the mapping, which
+                # is unmapped once the last of them has been released
+                pass
+
+        if self.handle is not None:
+            # the handle may be reused as soon as the buffer is destroyed
+            for cache in list(self.device.framebuffer_caches):
+                cache.invalidate(self)
+
+            args = mode_destroy_dumb()
+            args.handle = self.handle
 
-        args = mode_destroy_dumb()
-        args.handle = self.handle
+            self.device.ioctl(IOCTL_MODE_DESTROY_DUMB, args)
 
-        self.device.ioctl(IOCTL_MODE_DESTROY_DUMB, args)
+        self.mmap = None
+        self.handle = None
 
     def __setitem__(self, key, value):
         mmap = self.map()
@@ -988,24 +1818,1048 @@ class DumbBuffer(GEM):
         offset = y * self.pitch + x * len(value)
         mmap[offset:offset + len(value)] = value
 
+    # The array keeps the mapping alive for as long as it exists, even after
+    # the buffer has been closed.
+    def as_array(self, format = None, channels = False, visible = True):
+        import numpy
+
+        if format is not None:
+            cpp = format.cpp[0]
+
+            if channels and isinstance(format.components, RGBA):
+                for c in [format.components.red, format.components.green,
+                          format.components.blue, format.components.alpha]:
+                    if c.width not in (0, 8) or c.shift % 8:
+                        raise Error('format %s has no byte-sized channels' % format.name)
+        else:
+            cpp = self.cpp
+
+        # expose the padding at the end of each row only if explicitly asked for
+        if visible:
+            width = self.width
+        else:
+            width = self.pitch // cpp
+
+        if channels or cpp == 3:
+            shape = (self.height, width, cpp)
+            strides = (self.pitch, cpp, 1)
+            dtype = numpy.uint8
+        else:
+            shape = (self.height, width)
+            strides = (self.pitch, cpp)
+            dtype = numpy.dtype('<u%u' % cpp)
+
+        # numpy.ndarray() only keeps a reference to the mapping, so go through
+        # frombuffer(), which holds on to the export for as long as any array
+        # derived from it exists
+        buffer = numpy.frombuffer(self.map(), numpy.uint8)
+
+        return numpy.ndarray(shape, dtype, buffer = buffer, strides = strides)
+
+    def fill(self, pixel):
+        self.fill_rect(0, 0, self.width, self.height, pixel)
+
+    def fill_rect(self, x, y, width, height, pixel):
+        mmap = self.map()
+
+        if x < 0 or y < 0 or x + width > self.width or y + height > self.height:
+            raise Error('rectangle %ux%u+%u+%u out of bounds' % (width, height, x, y))
+
+        pixel = memoryview(pixel).tobytes()
+
+        if len(pixel) != self.cpp:
+            raise ValueError('pixel has %u bytes, buffer has %u bytes per pixel' %
+                             (len(pixel), self.cpp))
+
+        line = pixel * width
+        offset = y * self.pitch + x * self.cpp
+
+        for row in range(height):
+            mmap[offset:offset + len(line)] = line
+            offset += self.pitch
+
+    def copy_rect(self, src, src_x, src_y, x, y, width, height):
+        if src.cpp != self.cpp:
+            raise Error('cannot copy between %u and %u bytes per pixel' % (src.cpp, self.cpp))
+
+        if x < 0 or y < 0 or x + width > self.width or y + height > self.height or \
+           src_x < 0 or src_y < 0 or src_x + width > src.width or src_y + height > src.height:
+            raise Error('rectangle %ux%u out of bounds' % (width, height))
+
+        length = width * self.cpp
+        dst = self.map()
+        data = memoryview(src.map())
+        rows = range(height)
+
+        # copy bottom-up if the source would be overwritten before it is read
+        if src is self and y > src_y:
+            rows = reversed(rows)
+
+        for row in rows:
+            offset = (src_y + row) * src.pitch + src_x * src.cpp
+            line = data[offset:offset + length]
+
+            if src is self:
+                line = bytes(line)
+
+            offset = (y + row) * self.pitch + x * self.cpp
+            dst[offset:offset + length] = line
+
+        data.release()
+
+    def write_rows(self, y, data, pitch = None):
+        mmap = self.map()
+        data = memoryview(data).cast('B')
+        length = self.width * self.cpp
+
+        if pitch is None:
+            pitch = length
+
+        rows = (len(data) + pitch - length) // pitch
+
+        if y < 0 or y + rows > self.height:
+            raise Error('%u rows at %u out of bounds' % (rows, y))
+
+        offset = y * self.pitch
+
+        if pitch == self.pitch:
+            mmap[offset:offset + len(data)] = data
+        else:
+            for row in range(rows):
+                mmap[offset:offset + length] = data[row * pitch:row * pitch + length]
+                offset += self.pitch
+
+        data.release()
+
+class DumbBufferPool:
+    def __init__(self, device, max_size = 64 * 1024 * 1024):
+        self.device = device
+        self.max_size = max_size
+        self.size = 0
+
+        # free buffers by geometry, and in least-recently-released order
+        self.free = {}
+        self.lru = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, width, height, bpp):
+        buffers = self.free.get((width, height, bpp))
+
+        if buffers:
+            buffer = buffers.pop()
+            del self.lru[buffer]
+            self.size -= buffer.size
+            self.hits += 1
+
+            return buffer
+
+        self.misses += 1
+
+        return self.device.create_dumb(width, height, bpp, 0)
+
+    def release(self, buffer):
+        key = (buffer.width, buffer.height, buffer.bpp)
+
+        self.free.setdefault(key, []).append(buffer)
+        self.lru[buffer] = key
+        self.size += buffer.size
+
+        while self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        buffer, key = self.lru.popitem(last = False)
+
+        self.free[key].remove(buffer)
+        if not self.free[key]:
+            del self.free[key]
+
+        self.size -= buffer.size
+        self.evictions += 1
+        buffer.close()
+
+    def clear(self):
+        while self.lru:
+            self.evict()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'buffers': len(self.lru),
+            'size': self.size,
+        }
+
+class Atomic(enum.IntFlag):
+    PAGE_FLIP_EVENT = 0x0001
+    PAGE_FLIP_ASYNC = 0x0002
+    TEST_ONLY = 0x0100
+    NONBLOCK = 0x0200
+    ALLOW_MODESET = 0x0400
+
+class AtomicRequest:
+    def __init__(self, device):
+        self.device = device
+        self.objects = {}
+
+    def __len__(self):
+        return sum(len(props) for props in self.objects.values())
+
+    def add(self, obj, prop, value):
+        if isinstance(prop, str):
+            for p in obj.properties:
+                if p.name == prop:
+                    prop = p
+                    break
+            else:
+                raise Error('object %u has no property %s' % (obj.id, prop))
+
+        obj_id = getattr(obj, 'id', obj)
+        prop_id = getattr(prop, 'id', prop)
+
+        # allow framebuffers, CRTCs, blobs, ... to be passed in directly
+        if value is None:
+            value = 0
+        else:
+            value = getattr(value, 'id', value)
+
+        self.objects.setdefault(obj_id, {})[prop_id] = value
+
+    def clear(self):
+        self.objects = {}
+
+    # IDs of the CRTCs that are certainly part of the commit, i.e. the CRTCs
+    # in the request and those that planes and connectors are attached to by
+    # it. The kernel sends a flip event for each of them.
+    def crtcs(self):
+        crtcs = set()
+
+        for obj_id, properties in self.objects.items():
+            if isinstance(self.device.objects.get(obj_id), CRTC):
+                crtcs.add(obj_id)
+
+            for prop_id, value in properties.items():
+                info = self.device.property_cache.get(prop_id)
+
+                if info is not None and info.name == 'CRTC_ID' and value:
+                    crtcs.add(value)
+
+        return crtcs
+
+    def commit(self, flags = 0, user_data = 0):
+        count = len(self)
+
+        objs = (ctypes.c_uint32 * len(self.objects))()
+        count_props = (ctypes.c_uint32 * len(self.objects))()
+        props = (ctypes.c_uint32 * count)()
+        values = (ctypes.c_uint64 * count)()
+
+        index = 0
+
+        for i, (obj_id, properties) in enumerate(self.objects.items()):
+            objs[i] = obj_id
+            count_props[i] = len(properties)
+
+            for prop_id, value in properties.items():
+                props[index] = prop_id
+                values[index] = value & 0xffffffffffffffff
+                index += 1
+
+        args = mode_atomic()
+        args.flags = flags
+        args.count_objs = len(self.objects)
+        args.objs_ptr = ctypes.addressof(objs)
+        args.count_props_ptr = ctypes.addressof(count_props)
+        args.props_ptr = ctypes.addressof(props)
+        args.prop_values_ptr = ctypes.addressof(values)
+        args.user_data = user_data
+
+        self.device.ioctl(IOCTL_MODE_ATOMIC, args)
+
+    def test(self, flags = 0):
+        self.commit(flags | Atomic.TEST_ONLY)
+
+class PageFlip(enum.IntFlag):
+    EVENT = 0x01
+    ASYNC = 0x02
+    TARGET_ABSOLUTE = 0x04
+    TARGET_RELATIVE = 0x08
+
+class Sequence(enum.IntFlag):
+    RELATIVE = 0x01
+    NEXT_ON_MISS = 0x02
+
+class Event:
+    def __init__(self, type, user_data, sequence, timestamp, crtc_id = 0):
+        self.type = type
+        self.user_data = user_data
+        self.sequence = sequence
+        # CLOCK_MONOTONIC, in nanoseconds
+        self.timestamp = timestamp
+        self.crtc_id = crtc_id
+
+    def __str__(self):
+        return '%u: sequence %u at %u ns (CRTC %u)' % (self.type, self.sequence,
+                                                      self.timestamp, self.crtc_id)
+
+class EventReader:
+    def __init__(self, device, loop = None, handler = None):
+        # must be created from a coroutine unless a loop is passed explicitly
+        if loop is None:
+            loop = asyncio.get_running_loop()
+
+        self.device = device
+        self.loop = loop
+        self.handler = handler
+        self.pending = {}
+        # number of events that atomic commits are still waiting for
+        self.remaining = {}
+        self.cookie = 0
+
+        self.loop.add_reader(self.device.fd, self.dispatch)
+
+    def close(self):
+        self.loop.remove_reader(self.device.fd)
+
+        for future in self.pending.values():
+            future.cancel()
+
+        self.pending = {}
+        self.remaining = {}
+
+    def future(self, count = 1):
+        self.cookie = (self.cookie + 1) & 0xffffffffffffffff or 1
+        future = self.loop.create_future()
+        self.pending[self.cookie] = future
+
+        if count > 1:
+            self.remaining[self.cookie] = count
+
+        return self.cookie, future
+
+    def discard(self, cookie):
+        del self.pending[cookie]
+        self.remaining.pop(cookie, None)
+
+    def dispatch(self):
+        try:
+            events = self.device.read_events()
+        except BlockingIOError:
+            return
+        except Exception as e:
+            # nothing will complete the pending requests anymore, and a file
+            # descriptor that stays in an error state would keep the loop busy
+            self.loop.remove_reader(self.device.fd)
+
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(e)
+
+            self.pending = {}
+            self.remaining = {}
+            return
+
+        for event in events:
+            future = self.pending.get(event.user_data)
+
+            if future is None:
+                if self.handler is not None:
+                    self.handler(event)
+
+                continue
+
+            # atomic commits send one event per CRTC
+            if event.user_data in self.remaining:
+                self.remaining[event.user_data] -= 1
+
+                if self.remaining[event.user_data] > 0:
+                    continue
+
+            self.discard(event.user_data)
+
+            if not future.done():
+                future.set_result(event)
+
+    async def page_flip(self, crtc, fb, flags = 0, sequence = 0):
+        cookie, future = self.future()
+
+        try:
+            self.device.page_flip(crtc, fb, flags | PageFlip.EVENT, cookie, sequence)
+        except Exception:
+            self.discard(cookie)
+            raise
+
+        return await future
+
+    # Completes with the last of the events for the CRTCs in the request (see
+    # AtomicRequest.crtcs()). CRTCs that are only affected because planes or
+    # connectors are detached from them send events that arrive after that
+    # and are passed to the handler.
+    async def commit(self, request, flags = 0):
+        cookie, future = self.future(len(request.crtcs()))
+
+        try:
+            request.commit(flags | Atomic.PAGE_FLIP_EVENT, cookie)
+        except Exception:
+            self.discard(cookie)
+            raise
+
+        return await future
+
+    async def vblank(self, crtc, count = 1):
+        cookie, future = self.future()
+
+        try:
+            self.device.queue_sequence(crtc, count, Sequence.RELATIVE, cookie)
+        except Exception:
+            self.discard(cookie)
+            raise
+
+        return await future
+
+class Swapchain:
+    class Buffer:
+        def __init__(self, index, dumb, fb):
+            self.index = index
+            self.dumb = dumb
+            self.fb = fb
+
+        def __repr__(self):
+            return '%u' % self.index
+
+    def __init__(self, device, crtc, width, height, format, count = 3, plane = None,
+                 reader = None):
+        if count < 2 or count > 4:
+            raise Error('swapchain needs 2-4 buffers, not %u' % count)
+
+        self.device = device
+        self.crtc = crtc
+        self.plane = plane
+        self.width = width
+        self.height = height
+        self.format = format
+        self.buffers = []
+
+        if reader is None:
+            self.reader = device.event_reader()
+            self.owns_reader = True
+        else:
+            self.reader = reader
+            self.owns_reader = False
+
+        for index in range(count):
+            dumb = device.create_dumb(width, height, format.cpp[0] * 8, 0)
+            fb = device.add_framebuffer(width, height, format, 0, dumb, dumb.pitch, 0, 0)
+            self.buffers.append(Swapchain.Buffer(index, dumb, fb))
+
+        self.free = list(self.buffers)
+        # buffer currently being scanned out
+        self.front = None
+        # flip that has been queued but not completed yet
+        self.flip = None
+
+    def close(self):
+        if self.flip is not None:
+            self.flip.cancel()
+
+        if self.owns_reader:
+            self.reader.close()
+
+        for buffer in self.buffers:
+            buffer.fb.close()
+
+        self.flip = None
+        self.front = None
+        self.free = []
+        self.buffers = []
+
+    def complete(self, buffer, task):
+        if task.cancelled() or task.exception() is not None:
+            self.free.append(buffer)
+            return
+
+        if self.front is not None:
+            self.free.append(self.front)
+
+        self.front = buffer
+
+    async def wait(self):
+        if self.flip is not None:
+            try:
+                await self.flip
+            finally:
+                self.flip = None
+
+    async def acquire(self):
+        while not self.free:
+            if self.flip is None:
+                raise Error('no free buffers and no flip pending')
+
+            await self.wait()
+
+        return self.free.pop(0)
+
+    async def present(self, buffer):
+        # only a single flip can be pending on a CRTC at any time
+        await self.wait()
+
+        if self.front is None and self.plane is not None:
+            self.plane.set(self.crtc, buffer.fb, 0, 0, 0, self.width, self.height,
+                           0, 0, self.width, self.height)
+            self.front = buffer
+            return
+
+        flip = self.reader.page_flip(self.crtc, buffer.fb)
+        self.flip = self.reader.loop.create_task(flip)
+        self.flip.add_done_callback(lambda task: self.complete(buffer, task))
+
 class Resolution:
     def __init__(self, width, height):
         self.width = width
         self.height = height
 
-class Device:
+ioctl_names = {}
+ioctl_modules = set()
+
+# Map an ioctl request number to its name by looking for IOCTL_* constants in
+# the drm modules that have been imported so far (e.g. drm.tegra). Misses are
+# not cached, because the module defining the ioctl may be imported later, so
+# each miss rescans the modules that weren't seen before. Only constants that
+# encode a DRM request (type 'd') are considered, which skips IOCTL_BASE.
+def ioctl_name(nr):
+    name = ioctl_names.get(nr)
+
+    if name is None:
+        for key, module in list(sys.modules.items()):
+            if module is None or key in ioctl_modules or key.split('.')[0] != 'drm':
+                continue
+
+            ioctl_modules.add(key)
+
+            for symbol, value in list(vars(module).items()):
+                if not isinstance(value, int) or (value >> IOC_TYPE_SHIFT) & 0xff != IOCTL_BASE:
+                    continue
+
+                for prefix in ('DRM_IOCTL_', 'IOCTL_'):
+                    if symbol.startswith(prefix):
+                        ioctl_names.setdefault(value, symbol[len(prefix):])
+                        break
+
+        name = ioctl_names.get(nr, '0x%08x' % nr)
+
+    return name
+
+class IoctlStat:
+    def __init__(self, nr):
+        self.nr = nr
+        self.name = ioctl_name(nr)
+        self.count = 0
+        self.errors = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        # number of calls by latency, in power of two buckets of nanoseconds
+        self.histogram = collections.Counter()
+
+    def record(self, duration, error):
+        self.count += 1
+        self.total += duration
+
+        if error:
+            self.errors += 1
+
+        if self.min is None or duration < self.min:
+            self.min = duration
+
+        if duration > self.max:
+            self.max = duration
+
+        self.histogram[duration.bit_length()] += 1
+
+    def stats(self):
+        histogram = {}
+
+        for bucket in sorted(self.histogram):
+            histogram[1 << bucket] = self.histogram[bucket]
+
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total': self.total,
+            'mean': self.total // self.count,
+            'min': self.min,
+            'max': self.max,
+            'histogram': histogram,
+        }
+
+# Collects per-ioctl counts and latencies (in nanoseconds) while attached to
+# a device. Used as a context manager it only measures the enclosed block.
+class IoctlStats:
+    def __init__(self, device):
+        self.device = device
+        self.entries = {}
+
+    def __enter__(self):
+        self.device.attach_stats(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.device.detach_stats(self)
+
+    def record(self, nr, duration, error):
+        entry = self.entries.get(nr)
+
+        if entry is None:
+            entry = self.entries[nr] = IoctlStat(nr)
+
+        entry.record(duration, error)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        stats = {}
+
+        for entry in sorted(self.entries.values(), key = lambda entry: -entry.total):
+            stats[entry.name] = entry.stats()
+
+        return stats
+
+    def __str__(self):
+        lines = [ '%-32s %8s %8s %12s %10s %10s' % ('ioctl', 'count', 'errors',
+                                                     'total (us)', 'mean (us)',
+                                                     'max (us)') ]
+
+        for name, stat in self.stats().items():
+            lines.append('%-32s %8u %8u %12.1f %10.1f %10.1f' % (name, stat['count'],
+                         stat['errors'], stat['total'] / 1000, stat['mean'] / 1000,
+                         stat['max'] / 1000))
+
+        return '\n'.join(lines)
+
+class Span:
+    def __init__(self, trace, name, category, args):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, key, value):
+        self.args[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.trace.add(self.name, self.category, self.start,
+                       time.perf_counter_ns(), self.args)
+
+class NullSpan:
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+null_span = NullSpan()
+
+# Timeline of spans in the Chrome/Perfetto JSON trace format. Only the most
+# recent max_events spans are kept until they are written out by flush().
+class Trace:
+    def __init__(self, max_events = 65536):
+        self.events = collections.deque(maxlen = max_events)
+        self.threads = {}
+        self.pid = os.getpid()
+
+    def span(self, name, category, args = None):
+        if args is None:
+            args = {}
+
+        return Span(self, name, category, args)
+
+    def add(self, name, category, start, end, args = None):
+        tid = threading.get_native_id()
+
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start / 1000,
+            'dur': (end - start) / 1000,
+            'pid': self.pid,
+            'tid': tid,
+        }
+
+        if args:
+            event['args'] = args
+
+        self.events.append(event)
+
+    def flush(self, path):
+        events = []
+
+        for tid, name in self.threads.items():
+            events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                            'tid': tid, 'args': { 'name': name } })
+
+        while self.events:
+            events.append(self.events.popleft())
+
+        with open(path, 'w') as f:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ns' }, f)
+
+tracer = None
+
+def start_tracing(max_events = 65536):
+    global tracer
+
+    tracer = Trace(max_events)
+
+    return tracer
+
+def stop_tracing():
+    global tracer
+
+    result, tracer = tracer, None
+
+    return result
+
+# returns a context manager that records a span while tracing is enabled
+def trace(name, category, args = None):
+    if tracer is None:
+        return null_span
+
+    return tracer.span(name, category, args)
+
+# Sizes in bytes of the arrays that the kernel writes through pointers passed
+# in ioctl arguments, needed to record and replay them.
+ioctl_buffers = {
+    version: [
+        ('name', lambda args: args.name_len),
+        ('date', lambda args: args.date_len),
+        ('desc', lambda args: args.desc_len),
+    ],
+    mode_resources: [
+        ('fb_id_ptr', lambda args: args.count_fbs * 4),
+        ('crtc_id_ptr', lambda args: args.count_crtcs * 4),
+        ('connector_id_ptr', lambda args: args.count_connectors * 4),
+        ('encoder_id_ptr', lambda args: args.count_encoders * 4),
+    ],
+    mode_get_connector: [
+        ('encoders_ptr', lambda args: args.count_encoders * 4),
+        ('modes_ptr', lambda args: args.count_modes * ctypes.sizeof(mode_info)),
+        ('props_ptr', lambda args: args.count_props * 4),
+        ('prop_values_ptr', lambda args: args.count_props * 8),
+    ],
+    mode_plane_resources: [
+        ('plane_id_ptr', lambda args: args.count_planes * 4),
+    ],
+    mode_get_plane: [
+        ('format_type_ptr', lambda args: args.count_format_types * 4),
+    ],
+    mode_obj_get_properties: [
+        ('props_ptr', lambda args: args.count_props * 4),
+        ('prop_values_ptr', lambda args: args.count_props * 8),
+    ],
+    # blob properties return pairs of 32-bit values and blob IDs instead
+    mode_get_property: [
+        ('values_ptr', lambda args: args.count_enum_blobs * 4 if args.flags & MODE_PROP_BLOB
+                                    else args.count_values * 8),
+        ('enum_blob_ptr', lambda args: args.count_enum_blobs * 4 if args.flags & MODE_PROP_BLOB
+                                       else args.count_enum_blobs * ctypes.sizeof(mode_property_enum)),
+    ],
+    mode_get_blob: [
+        ('data', lambda args: args.length),
+    ],
+    mode_create_blob: [
+        ('data', lambda args: 0),
+    ],
+}
+
+pointer_ranges = {}
+
+# ranges of ioctl arguments holding user pointers, which differ between runs
+def get_pointer_ranges(struct):
+    ranges = pointer_ranges.get(struct)
+
+    if ranges is None:
+        names = [name for name, _ in ioctl_buffers.get(struct, [])]
+        ranges = []
+
+        for name, ctype in getattr(struct, '_fields_', []):
+            if name in names or name.endswith('_ptr') or \
+               issubclass(ctype, (ctypes._Pointer, ctypes.c_char_p, ctypes.c_void_p)):
+                field = getattr(struct, name)
+                ranges.append((field.offset, field.size))
+
+        pointer_ranges[struct] = ranges
+
+    return ranges
+
+def ioctl_key(args):
+    # some ioctls take a plain integer argument
+    if isinstance(args, int):
+        return repr(args).encode()
+
+    key = bytearray(bytes(args))
+
+    for offset, size in get_pointer_ranges(type(args)):
+        key[offset:offset + size] = bytes(size)
+
+    return bytes(key)
+
+def read_pointer(args, name):
+    field = getattr(type(args), name)
+    data = bytes(args)[field.offset:field.offset + field.size]
+
+    return int.from_bytes(data, sys.byteorder)
+
+class KernelBackend:
+    def open(self, path):
+        return os.open(path, os.O_RDWR)
+
+    def close(self, fd):
+        os.close(fd)
+
+    def ioctl(self, fd, nr, args):
+        return fcntl.ioctl(fd, nr, args)
+
+    def mmap(self, fd, offset, length, flags, prot, access):
+        return mmap.mmap(fd, length, flags, prot, access, offset)
+
+RECORDING_MAGIC = b'DRMREC\0\0'
+
+# Passes ioctls through to another backend and records them, including the
+# arrays written by the kernel, to a file when the device is closed.
+class RecordBackend(KernelBackend):
+    def __init__(self, path, backend = None):
+        self.path = path
+        self.backend = backend or KernelBackend()
+        self.entries = []
+
+    def open(self, path):
+        return self.backend.open(path)
+
+    def close(self, fd):
+        self.backend.close(fd)
+        self.save()
+
+    def ioctl(self, fd, nr, args):
+        buffers = ioctl_buffers.get(type(args), [])
+        sizes = [size(args) for _, size in buffers]
+        key = ioctl_key(args)
+
+        try:
+            result = self.backend.ioctl(fd, nr, args)
+        except OSError as e:
+            self.entries.append((nr, key, b'', [], 0, e.errno))
+            raise
+
+        if isinstance(args, int):
+            output = b''
+        else:
+            output = bytes(args)
+
+        data = []
+
+        # the kernel writes no more than was passed in, nor than it reports
+        for (name, size), before in zip(buffers, sizes):
+            pointer = read_pointer(args, name)
+            length = min(before, size(args))
+
+            if pointer and length > 0:
+                data.append(ctypes.string_at(pointer, length))
+            else:
+                data.append(b'')
+
+        self.entries.append((nr, key, output, data, result, 0))
+
+        return result
+
+    def mmap(self, fd, offset, length, flags, prot, access):
+        return self.backend.mmap(fd, offset, length, flags, prot, access)
+
+    def save(self):
+        with open(self.path, 'wb') as f:
+            f.write(RECORDING_MAGIC)
+            marshal.dump(self.entries, f)
+
+# Replays a recording made by RecordBackend without any device present. Calls
+# are matched by request number and arguments (ignoring pointers), so the
+# order may differ from the recording. The last response for each call is
+# repeated once the recorded ones have been used up.
+class ReplayBackend(KernelBackend):
     def __init__(self, path):
-        self.fd = os.open(path, os.O_RDWR)
+        self.responses = {}
+
+        with open(path, 'rb') as f:
+            if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+                raise Error('%s: not an ioctl recording' % path)
+
+            entries = marshal.load(f)
+
+        for nr, key, output, data, result, error in entries:
+            responses = self.responses.setdefault((nr, key), [[], 0])
+            responses[0].append((output, data, result, error))
+
+    def open(self, path):
+        return -1
+
+    def close(self, fd):
+        pass
+
+    def ioctl(self, fd, nr, args):
+        responses = self.responses.get((nr, ioctl_key(args)))
+
+        if responses is None:
+            raise Error('no recorded response for %s' % ioctl_name(nr))
+
+        entries, index = responses
+        output, data, result, error = entries[index]
+
+        if index + 1 < len(entries):
+            responses[1] = index + 1
+
+        if error:
+            raise OSError(error, os.strerror(error))
+
+        if output:
+            current = bytes(args)
+            output = bytearray(output)
+
+            # keep the pointers of this call
+            for offset, size in get_pointer_ranges(type(args)):
+                output[offset:offset + size] = current[offset:offset + size]
+
+            ctypes.memmove(ctypes.addressof(args), bytes(output), len(output))
+
+        for (name, _), chunk in zip(ioctl_buffers.get(type(args), []), data):
+            pointer = read_pointer(args, name)
+
+            if pointer and chunk:
+                ctypes.memmove(pointer, chunk, len(chunk))
+
+        return result
+
+    def mmap(self, fd, offset, length, flags, prot, access):
+        return mmap.mmap(-1, length)
+
+class Device:
+    backend = KernelBackend()
+
+    # Properties whose blobs are created along with their object and never
+    # replaced, so their IDs can't be recycled while they are cached. Blobs of
+    # mutable properties (MODE_ID, ...) are replaced on commit, and even those
+    # of immutable connector properties (EDID, PATH, TILE) on hotplug.
+    static_blobs = { 'IN_FORMATS', 'SIZE_HINTS' }
+
+    def __init__(self, path, backend = None):
+        if backend is not None:
+            self.backend = backend
+
+        self.fd = self.backend.open(path)
         self.path = path
 
+        # property metadata is immutable for the lifetime of the device
+        self.property_cache = {}
+        self.blob_cache = BlobCache()
+
+        # blobs created by us, by hash of their contents
+        self.blobs = {}
+
+        # framebuffer caches, which need to drop buffer objects being destroyed
+        self.framebuffer_caches = weakref.WeakSet()
+
+        # whether the ATOMIC client capability was enabled
+        self.atomic = False
+
+        # KMS objects by ID, and CRTCs/encoders by possible_* bitmask
+        self.objects = {}
+        self.crtc_masks = {}
+        self.encoder_masks = {}
+        self.crtcs = []
+        self.encoders = []
+
     def close(self):
-        os.close(self.fd)
+        self.backend.close(self.fd)
 
     def ioctl(self, nr, args):
-        return fcntl.ioctl(self.fd, nr, args)
+        if tracer is None:
+            return self.backend.ioctl(self.fd, nr, args)
+
+        span = tracer.span(ioctl_name(nr), 'ioctl', { 'bytes': (nr >> 16) & 0x3fff })
+
+        with span:
+            return self.backend.ioctl(self.fd, nr, args)
+
+    # Installed as the instance's ioctl() while any statistics are attached,
+    # so that there is no overhead at all otherwise.
+    def timed_ioctl(self, nr, args):
+        start = time.perf_counter_ns()
+        error = True
+
+        try:
+            result = type(self).ioctl(self, nr, args)
+            error = False
+        finally:
+            duration = time.perf_counter_ns() - start
+
+            for stats in self.__dict__.get('ioctl_collectors', ()):
+                stats.record(nr, duration, error)
+
+        return result
+
+    def attach_stats(self, stats):
+        collectors = self.__dict__.setdefault('ioctl_collectors', [])
+        collectors.append(stats)
+        self.ioctl = self.timed_ioctl
+
+    def detach_stats(self, stats):
+        collectors = self.__dict__.get('ioctl_collectors', [])
+
+        if stats in collectors:
+            collectors.remove(stats)
+
+        if not collectors:
+            self.__dict__.pop('ioctl', None)
+
+    def measure(self):
+        return IoctlStats(self)
+
+    def enable_stats(self, enable = True):
+        stats = self.__dict__.get('ioctl_stats')
+
+        if enable:
+            if stats is None:
+                stats = self.ioctl_stats = IoctlStats(self)
+                self.attach_stats(stats)
+        else:
+            if stats is not None:
+                self.detach_stats(stats)
+                del self.ioctl_stats
+
+    def stats(self):
+        stats = self.__dict__.get('ioctl_stats')
+
+        if stats is None:
+            return {}
+
+        return stats.stats()
 
     def mmap(self, offset, length, flags = mmap.MAP_SHARED, prot = mmap.PROT_WRITE | mmap.PROT_READ, access = mmap.ACCESS_DEFAULT):
-        return mmap.mmap(self.fd, length, flags, prot, access, offset)
+        with trace('mmap', 'mmap', { 'bytes': length }):
+            return self.backend.mmap(self.fd, offset, length, flags, prot, access)
 
     def version(self):
         v = version()
@@ -1074,16 +2928,19 @@ class Device:
 
         return args.handle
 
-    def get_property(self, prop_id, value):
+    def get_property_info(self, prop_id):
+        info = self.property_cache.get(prop_id)
+
+        if info is not None:
+            return info
+
         args = mode_get_property()
         args.prop_id = prop_id
+        values = []
+        blobs = []
 
         self.ioctl(IOCTL_MODE_GETPROPERTY, args)
 
-        name = args.name.decode('utf-8')
-        flags = get_flags(args.flags)
-        prop = None
-
         if args.count_values > 0:
             values = (ctypes.c_uint64 * args.count_values)()
             args.values_ptr = ctypes.addressof(values)
@@ -1102,111 +2959,193 @@ class Device:
 
         self.ioctl(IOCTL_MODE_GETPROPERTY, args)
 
-        if 0:
-            print('property: value %s' % value)
-            print('  values_ptr:', args.values_ptr)
-            print('  enum_blob_ptr:', args.enum_blob_ptr)
-            print('  prop_id:', args.prop_id)
-            print('  flags:', args.flags)
-            print('  name:', args.name)
-            print('  count_values:', args.count_values)
-            print('  count_enum_blobs:', args.count_enum_blobs)
+        enums = {}
 
-        if args.flags & MODE_PROP_PENDING:
-            raise NotImplemented('unable to parse pending properties')
+        if args.flags & (MODE_PROP_ENUM | MODE_PROP_BITMASK):
+            for blob in blobs:
+                enums[blob.name.decode('utf-8')] = blob.value
 
-        if args.flags & MODE_PROP_RANGE:
-            return PropertyRange(prop_id, name, flags, values[0], values[1], value)
+        info = PropertyInfo(prop_id, args.name.decode('utf-8'), args.flags,
+                            list(values), enums)
+        self.property_cache[prop_id] = info
 
-        if args.flags & MODE_PROP_ENUM:
-            enums = {}
+        return info
 
-            for blob in blobs:
-                enum = blob.name.decode('utf-8')
-                enums[enum] = blob.value
+    def get_property(self, prop_id, value):
+        info = self.get_property_info(prop_id)
+        name = info.name
+        flags = info.flag_names
+
+        if info.flags & MODE_PROP_PENDING:
+            raise NotImplementedError('unable to parse pending properties')
 
-            return PropertyEnum(prop_id, name, flags, enums, value)
+        if info.flags & MODE_PROP_RANGE:
+            return PropertyRange(prop_id, name, flags, info.values[0], info.values[1], value)
 
-        if args.flags & MODE_PROP_BLOB:
-            if args.count_enum_blobs > 0:
-                raise NotImplemented('unable to parse %u enum blobs' %
-                                        args.count_enum_blobs)
+        if info.flags & MODE_PROP_ENUM:
+            return PropertyEnum(prop_id, name, flags, info.enums, value)
+
+        if info.flags & MODE_PROP_BLOB:
+            if value > 0:
+                blob = self.get_blob(value, name in Device.static_blobs)
             else:
-                if value > 0:
-                    blob = self.get_blob(value)
-                else:
-                    blob = None
+                blob = None
 
             return PropertyBlob(prop_id, name, flags, blob)
 
-        if args.flags & MODE_PROP_BITMASK:
-            raise NotImplemented('unable to parse bitmask properties')
+        if info.flags & MODE_PROP_BITMASK:
+            return PropertyBitmask(prop_id, name, flags, info.enums, value)
 
-        prop_type = args.flags & MODE_PROP_EXTENDED_TYPE
+        prop_type = info.flags & MODE_PROP_EXTENDED_TYPE
 
         if prop_type == MODE_PROP_OBJECT:
-            raise NotImplemented('unable to parse object properties')
+            obj_type = info.values[0] if info.values else 0
+            return PropertyObject(prop_id, name, flags, obj_type, value)
 
         if prop_type == MODE_PROP_SIGNED_RANGE:
-            raise NotImplemented('unable to parse signed range properties')
+            minimum = ctypes.c_int64(info.values[0]).value
+            maximum = ctypes.c_int64(info.values[1]).value
+            value = ctypes.c_int64(value).value
+
+            return PropertySignedRange(prop_id, name, flags, minimum, maximum, value)
+
+        return None
+
+    def get_property_values(self, obj_type, obj_id):
+        args = mode_obj_get_properties()
+        args.obj_type = obj_type
+        args.obj_id = obj_id
+
+        self.ioctl(IOCTL_MODE_OBJ_GETPROPERTIES, args)
+
+        if args.count_props > 0:
+            props = (ctypes.c_uint32 * args.count_props)()
+            args.props_ptr = props
+
+            values = (ctypes.c_uint64 * args.count_props)()
+            args.prop_values_ptr = values
+
+            self.ioctl(IOCTL_MODE_OBJ_GETPROPERTIES, args)
 
-        if not prop:
-            if args.count_values > 0:
-                print('  values: %u' % args.count_values)
+            return list(zip(props, values))
 
-                for value in values:
-                    print('    %u' % value)
+        return []
 
-            if args.count_enum_blobs > 0:
-                print('  enum blobs: %u' % args.count_enum_blobs)
+    def decode_properties(self, values):
+        properties = []
 
-                for blob in blobs:
-                    print('    %s' % blob)
+        for prop, value in values:
+            prop = self.get_property(prop, value)
+            properties.append(prop)
 
-            if args.flags & MODE_PROP_ENUM:
-                self.values = {}
+        return properties
 
-                if args.count_enum_blobs > 0:
-                    for blob in blobs:
-                        self.values[blob.name] = blob.value
+    def get_properties(self, obj_type, obj_id):
+        values = self.get_property_values(obj_type, obj_id)
 
-        return prop
+        return self.decode_properties(values)
 
-    def get_blob(self, blob_id):
+    # Blob IDs are recycled as soon as a blob is destroyed, and the new blob
+    # can have the same size as the old one, so nothing returned by the kernel
+    # tells a cached blob apart from its successor. Only pass cache = True for
+    # blobs that are known to live as long as the cache entry, such as those
+    # of the properties in static_blobs.
+    def get_blob(self, blob_id, cache = False):
         args = mode_get_blob()
         args.blob_id = blob_id
         data = None
 
-        self.ioctl(IOCTL_MODE_GETPROPBLOB, args)
+        try:
+            self.ioctl(IOCTL_MODE_GETPROPBLOB, args)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                self.blob_cache.invalidate(blob_id)
 
-        #print('  blob: %u' % blob_id)
-        #print('    length: %u bytes' % args.length)
+            raise
 
         if args.length > 0:
-            data = (ctypes.c_byte * args.length)()
-            args.data = data
+            if cache:
+                data = self.blob_cache.lookup(blob_id, args.length)
 
-            self.ioctl(IOCTL_MODE_GETPROPBLOB, args)
+            if data is None:
+                data = (ctypes.c_byte * args.length)()
+                args.data = data
 
-            data = bytes(data)
+                self.ioctl(IOCTL_MODE_GETPROPBLOB, args)
 
-        #print('    data:\n     ', end = '')
-        #count = 0
+                data = bytes(data)
 
-        #for byte in self.data:
-        #    if count >= 16:
-        #        print('\n     ', end = '')
-        #        count = 0
+                if cache:
+                    data = self.blob_cache.insert(blob_id, data)
 
-        #    print(' %02x' % byte, end = '')
-        #    count += 1
+        return Blob(blob_id, data)
 
-        #print()
+    def create_blob(self, data):
+        data = bytes(data)
+        digest = hashlib.sha256(data).digest()
+        entry = self.blobs.get(digest)
 
-        return Blob(blob_id, data)
+        # reuse an existing blob with the same contents
+        if entry is not None:
+            entry[1] += 1
+            return entry[0]
+
+        buf = ctypes.create_string_buffer(data, len(data))
+
+        args = mode_create_blob()
+        args.data = ctypes.addressof(buf)
+        args.length = len(data)
+
+        self.ioctl(IOCTL_MODE_CREATEPROPBLOB, args)
+
+        blob = Blob(args.blob_id, data)
+        self.blobs[digest] = [blob, 1]
+
+        return blob
 
-    def get_resources(self):
+    def destroy_blob(self, blob):
+        digest = hashlib.sha256(blob.data).digest()
+        entry = self.blobs.get(digest)
+
+        if entry is None or entry[0].id != blob.id:
+            raise NotFound('blob %u was not created by this device' % blob.id)
+
+        entry[1] -= 1
+
+        if entry[1] == 0:
+            args = mode_destroy_blob()
+            args.blob_id = blob.id
+
+            self.ioctl(IOCTL_MODE_DESTROYPROPBLOB, args)
+            self.blob_cache.invalidate(blob.id)
+
+            del self.blobs[digest]
+
+    def crtcs_from_mask(self, mask):
+        crtcs = self.crtc_masks.get(mask)
+
+        if crtcs is None:
+            crtcs = [self.crtcs[bit] for bit in set_bits(mask, len(self.crtcs))]
+            self.crtc_masks[mask] = crtcs
+
+        return list(crtcs)
+
+    def encoders_from_mask(self, mask):
+        encoders = self.encoder_masks.get(mask)
+
+        if encoders is None:
+            encoders = [self.encoders[bit] for bit in set_bits(mask, len(self.encoders))]
+            self.encoder_masks[mask] = encoders
+
+        return list(encoders)
+
+    def get_resource_ids(self):
         args = mode_resources()
+        fbs = []
+        crtcs = []
+        connectors = []
+        encoders = []
+        planes = []
 
         self.ioctl(IOCTL_MODE_GETRESOURCES, args)
 
@@ -1231,64 +3170,230 @@ class Device:
 
         self.ioctl(IOCTL_MODE_GETRESOURCES, args)
 
+        # retrieve plane information
+        args = mode_plane_resources()
+
+        self.ioctl(IOCTL_MODE_GETPLANERESOURCES, args)
+
+        if args.count_planes > 0:
+            planes = (ctypes.c_uint32 * args.count_planes)()
+            args.plane_id_ptr = planes
+
+        self.ioctl(IOCTL_MODE_GETPLANERESOURCES, args)
+
+        return list(fbs), list(crtcs), list(encoders), list(connectors), list(planes)
+
+    def create_objects(self, ids, probe = False):
+        fbs, crtcs, encoders, connectors, planes = ids
+
+        self.resource_ids = ids
         self.framebuffers = []
         self.crtcs = []
         self.connectors = []
         self.encoders = []
         self.planes = []
 
-        if args.count_fbs > 0:
-            for fb in fbs:
-                fb = Framebuffer(self, fb)
-                self.framebuffers.append(fb)
+        self.objects = {}
+        self.crtc_masks = {}
+        self.encoder_masks = {}
+
+        for fb in fbs:
+            fb = Framebuffer(self, fb)
+            self.framebuffers.append(fb)
+            self.objects[fb.id] = fb
+
+        for index, crtc in enumerate(crtcs):
+            crtc = CRTC(self, index, crtc, True)
+            self.crtcs.append(crtc)
+            self.objects[crtc.id] = crtc
+
+        for index, encoder in enumerate(encoders):
+            encoder = Encoder(self, index, encoder, True)
+            self.encoders.append(encoder)
+            self.objects[encoder.id] = encoder
+
+        for connector in connectors:
+            connector = Connector(self, connector, probe, True)
+            self.connectors.append(connector)
+            self.objects[connector.id] = connector
+
+        for plane in planes:
+            plane = Plane(self, plane, True)
+            self.planes.append(plane)
+            self.objects[plane.id] = plane
+
+    def get_resources(self, probe = False, lazy = False):
+        self.create_objects(self.get_resource_ids(), probe)
+
+        # all handles exist at this point, so references between objects can
+        # be resolved in any order while fetching
+        if not lazy:
+            for obj in self.crtcs + self.encoders + self.connectors + self.planes:
+                obj.fetch()
+
+    SNAPSHOT_MAGIC = b'DRMSNAP\0'
+    SNAPSHOT_VERSION = 2
+    # magic, format and marshal versions, SHA-256 of the topology key
+    snapshot_header = struct.Struct('<8sHH32s')
+
+    # Status and EDID of every connector, which change when monitors are
+    # plugged, unplugged or swapped. They are read from sysfs, which needs no
+    # ioctls, or from the current connector state (without probing) if the
+    # device has no sysfs entries, such as the software device.
+    def hotplug_fingerprint(self, ids):
+        connectors = CardDevice(self.path).connectors
+        result = []
+
+        for connector in connectors:
+            status = read_sysfs(os.path.join(connector.path, 'status'))
+            edid = connector.edid or b''
+            result.append((connector.name, status, hashlib.sha256(edid).digest()))
+
+        if connectors:
+            return result
+
+        for connector_id in ids[3]:
+            args = mode_get_connector()
+            args.connector_id = connector_id
+
+            # a non-zero mode count avoids probing, see Connector.update()
+            mode = mode_info()
+            args.count_modes = 1
+            args.modes_ptr = ctypes.pointer(mode)
+
+            self.ioctl(IOCTL_MODE_GETCONNECTOR, args)
 
-        if args.count_crtcs > 0:
-            index = 0
+            props = (ctypes.c_uint32 * args.count_props)()
+            prop_values = (ctypes.c_uint64 * args.count_props)()
+
+            args.count_encoders = 0
+            args.count_modes = 1
+            args.props_ptr = props
+            args.prop_values_ptr = prop_values
 
-            for crtc in crtcs:
-                crtc = CRTC(self, index, crtc)
-                self.crtcs.append(crtc)
-                index = index + 1
+            self.ioctl(IOCTL_MODE_GETCONNECTOR, args)
+
+            edid = b''
+
+            for prop, value in zip(props, prop_values):
+                if value and self.get_property_info(prop).name == 'EDID':
+                    edid = self.get_blob(value).data or b''
+
+            result.append((connector_id, args.connection, hashlib.sha256(edid).digest()))
 
-        if args.count_encoders > 0:
-            index = 0
+        return result
+
+    def snapshot_key(self, ids, epoch):
+        version = self.version()
+        # framebuffers come and go, so they don't invalidate a snapshot
+        key = (version.name, version.major, version.minor, version.patch,
+               version.date, epoch, ids[1:], self.hotplug_fingerprint(ids))
+
+        return hashlib.sha256(repr(key).encode()).digest()
+
+    # Save the topology last retrieved by get_resources() so that it can be
+    # restored by restore_snapshot() without probing. Snapshots are keyed by
+    # the connector status and EDIDs, so they don't survive hotplug. Callers
+    # can pass an epoch to invalidate them for other reasons.
+    def snapshot(self, path, epoch = 0):
+        key = self.snapshot_key(self.resource_ids, epoch)
+        objects = self.crtcs + self.encoders + self.connectors + self.planes
+        states = [obj.save() for obj in objects]
+        properties = []
+        blobs = {}
 
-            for encoder in encoders:
-                encoder = Encoder(self, index, encoder)
-                self.encoders.append(encoder)
-                index = index + 1
+        # only blobs that can be cached are saved, see Device.static_blobs
+        for obj in objects:
+            for prop in obj.properties:
+                if isinstance(prop, PropertyBlob) and prop.blob is not None and \
+                   prop.name in Device.static_blobs:
+                    blobs[prop.blob.id] = prop.blob.data
 
-            # resolve possible clones
-            for encoder in self.encoders:
-                possible_clones = []
+        for info in self.property_cache.values():
+            properties.append((info.id, info.name, info.flags, info.values,
+                               list(info.enums.items())))
 
-                for bit in set_bits(encoder.possible_clones, 32):
-                    for clone in self.encoders:
-                        if clone.index == bit:
-                            possible_clones.append(clone)
+        header = self.snapshot_header.pack(Device.SNAPSHOT_MAGIC,
+                                           Device.SNAPSHOT_VERSION,
+                                           marshal.version, key)
+        data = marshal.dumps((properties, blobs, states))
 
-                encoder.possible_clones = possible_clones
+        # Write to a uniquely named temporary file in the same directory first,
+        # so that readers never see partial data and concurrent writers don't
+        # clobber each other's files.
+        directory, name = os.path.split(path)
+        temp = tempfile.NamedTemporaryFile(dir = directory or '.', prefix = name + '.',
+                                           delete = False)
 
-        if args.count_connectors > 0:
-            for connector in connectors:
-                connector = Connector(self, connector)
-                self.connectors.append(connector)
+        try:
+            with temp:
+                temp.write(header + data)
 
-        # retrieve plane information
-        args = mode_plane_resources()
+            os.replace(temp.name, path)
+        except:
+            os.unlink(temp.name)
+            raise
 
-        self.ioctl(IOCTL_MODE_GETPLANERESOURCES, args)
+    # Snapshots that are missing, stale or corrupt make this return False, in
+    # which case the caller should fall back to get_resources(). Note that
+    # marshal is not meant for untrusted data, so snapshots must be stored
+    # where only trusted users can write them.
+    def restore_snapshot(self, path, epoch = 0):
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(self.snapshot_header.size)
+                data = f.read()
+        except OSError:
+            return False
 
-        if args.count_planes > 0:
-            planes = (ctypes.c_uint32 * args.count_planes)()
-            args.plane_id_ptr = planes
+        if len(header) < self.snapshot_header.size:
+            return False
 
-        self.ioctl(IOCTL_MODE_GETPLANERESOURCES, args)
+        magic, version, marshal_version, key = self.snapshot_header.unpack(header)
 
-        if args.count_planes > 0:
-            for plane in planes:
-                plane = Plane(self, plane)
-                self.planes.append(plane)
+        if magic != Device.SNAPSHOT_MAGIC or \
+           version != Device.SNAPSHOT_VERSION or \
+           marshal_version != marshal.version:
+            return False
+
+        ids = self.get_resource_ids()
+
+        if key != self.snapshot_key(ids, epoch):
+            return False
+
+        # the payload is only decoded once the key matches
+        added = []
+
+        try:
+            properties, blobs, states = marshal.loads(data)
+
+            for prop_id, name, flags, values, enums in properties:
+                if prop_id not in self.property_cache:
+                    info = PropertyInfo(prop_id, name, flags, values, dict(enums))
+                    self.property_cache[prop_id] = info
+                    added.append(prop_id)
+
+            self.create_objects(ids)
+
+            objects = self.crtcs + self.encoders + self.connectors + self.planes
+
+            if len(states) != len(objects):
+                raise ValueError('snapshot has %u objects, expected %u' %
+                                 (len(states), len(objects)))
+
+            for obj, state in zip(objects, states):
+                obj.restore(state)
+
+            for blob_id, data in blobs.items():
+                self.blob_cache.insert(blob_id, data)
+        except (EOFError, ValueError, TypeError, KeyError, IndexError):
+            # don't keep property metadata from a corrupt snapshot around
+            for prop_id in added:
+                del self.property_cache[prop_id]
+
+            return False
+
+        return True
 
     def create_dumb(self, width, height, bpp, flags):
         args = mode_create_dumb()
@@ -1299,7 +3404,10 @@ class Device:
 
         self.ioctl(IOCTL_MODE_CREATE_DUMB, args)
 
-        return DumbBuffer(self, width, height, args.handle, args.pitch, args.size)
+        return DumbBuffer(self, width, height, bpp, args.handle, args.pitch, args.size)
+
+    def create_dumb_pool(self, max_size = 64 * 1024 * 1024):
+        return DumbBufferPool(self, max_size)
 
     def add_framebuffer(self, width, height, pixel_format, flags, objects,
                         pitches, offsets, modifiers):
@@ -1331,12 +3439,177 @@ class Device:
 
         self.ioctl(IOCTL_MODE_ADDFB2, args)
 
-        return Framebuffer(self, args.fb_id)
+        return Framebuffer(self, args.fb_id, objects)
+
+    def remove_framebuffer(self, fb):
+        fb.close()
+
+    def create_framebuffer_cache(self, max_entries = 16):
+        cache = FramebufferCache(self, max_entries)
+        self.framebuffer_caches.add(cache)
+
+        return cache
+
+    # Without the ATOMIC client capability the kernel rejects atomic commits
+    # and hides atomic properties (FB_ID, CRTC_ID, ACTIVE, MODE_ID, ...). This
+    # also enables universal planes, so call it before get_resources(), which
+    # otherwise enumerates only overlay planes. Properties of objects that
+    # were already fetched are fetched again on next access.
+    def enable_atomic(self):
+        self.set_capability(ClientCapability.ATOMIC, True)
+        self.atomic = True
+
+        for obj in self.objects.values():
+            if isinstance(obj, LazyObject):
+                obj.reset_properties()
+
+    def atomic_request(self):
+        if not self.atomic:
+            self.enable_atomic()
+
+        return AtomicRequest(self)
+
+    def page_flip(self, crtc, fb, flags = PageFlip.EVENT, user_data = 0, sequence = 0):
+        args = mode_crtc_page_flip()
+        args.crtc_id = crtc.id
+        args.fb_id = fb.id
+        args.flags = flags
+        args.sequence = sequence
+        args.user_data = user_data
+
+        self.ioctl(IOCTL_MODE_PAGE_FLIP, args)
+
+    def queue_sequence(self, crtc, sequence, flags = 0, user_data = 0):
+        args = crtc_queue_sequence()
+        args.crtc_id = crtc.id
+        args.flags = flags
+        args.sequence = sequence
+        args.user_data = user_data
+
+        self.ioctl(IOCTL_CRTC_QUEUE_SEQUENCE, args)
+
+        return args.sequence
+
+    def read_events(self):
+        data = os.read(self.fd, 4096)
+        events = []
+        offset = 0
+
+        while offset + ctypes.sizeof(event) <= len(data):
+            header = event.from_buffer_copy(data, offset)
+
+            if header.type == EVENT_VBLANK or header.type == EVENT_FLIP_COMPLETE:
+                ev = event_vblank.from_buffer_copy(data, offset)
+                timestamp = ev.tv_sec * 1000000000 + ev.tv_usec * 1000
+                events.append(Event(ev.base.type, ev.user_data, ev.sequence,
+                                    timestamp, ev.crtc_id))
+            elif header.type == EVENT_CRTC_SEQUENCE:
+                ev = event_crtc_sequence.from_buffer_copy(data, offset)
+                events.append(Event(ev.base.type, ev.user_data, ev.sequence,
+                                    ev.time_ns))
+
+            # unknown events are skipped
+            if header.length == 0:
+                break
+
+            offset += header.length
+
+        return events
+
+    def event_reader(self, loop = None, handler = None):
+        return EventReader(self, loop, handler)
+
+SYSFS_PATH = os.path.join(os.path.sep, 'sys', 'class', 'drm')
+
+def read_sysfs(path, binary = False):
+    try:
+        with open(path, 'rb' if binary else 'r') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    if binary:
+        return data
+
+    return data.strip()
+
+def sysfs_link(path):
+    if not os.path.exists(path):
+        return None
+
+    return os.path.basename(os.path.realpath(path))
+
+# connector state as exported by the kernel, available without opening the
+# device and without triggering a probe
+class SysfsConnector:
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+    @property
+    def status(self):
+        status = read_sysfs(os.path.join(self.path, 'status'))
+
+        if status is None:
+            return None
+
+        return Connector.Status[status.upper()]
+
+    @property
+    def enabled(self):
+        return read_sysfs(os.path.join(self.path, 'enabled')) == 'enabled'
+
+    @property
+    def edid(self):
+        edid = read_sysfs(os.path.join(self.path, 'edid'), binary = True)
+
+        if not edid:
+            return None
+
+        return edid
+
+    @property
+    def modes(self):
+        modes = read_sysfs(os.path.join(self.path, 'modes'))
+
+        if not modes:
+            return []
+
+        return modes.split('\n')
+
+    def __str__(self):
+        return '%s (%s)' % (self.name, self.status)
 
 class DeviceNode:
     def __init__(self, path):
         self.path = path
         self.fd = None
+        self.sysfs = os.path.join(SYSFS_PATH, os.path.basename(path))
+
+    # Note that this is the kernel driver bound to the parent device, which
+    # isn't always the DRM driver name returned by Device.version(). On Tegra
+    # for example, the DRM device is bound to the "drm" driver on the "host1x"
+    # bus.
+    @property
+    def driver(self):
+        return sysfs_link(os.path.join(self.sysfs, 'device', 'driver'))
+
+    @property
+    def bus(self):
+        return sysfs_link(os.path.join(self.sysfs, 'device', 'subsystem'))
+
+    @property
+    def bus_id(self):
+        return sysfs_link(os.path.join(self.sysfs, 'device'))
+
+    @property
+    def boot_vga(self):
+        boot_vga = read_sysfs(os.path.join(self.sysfs, 'device', 'boot_vga'))
+
+        if boot_vga is None:
+            return None
+
+        return boot_vga == '1'
 
     def __del__(self):
         if self.fd:
@@ -1351,6 +3624,24 @@ class CardDevice(DeviceNode):
     def __init__(self, path):
         super().__init__(path)
 
+    @property
+    def connectors(self):
+        prefix = os.path.basename(self.path) + '-'
+        connectors = []
+
+        try:
+            names = sorted(os.listdir(SYSFS_PATH))
+        except OSError:
+            return connectors
+
+        for name in names:
+            if name.startswith(prefix):
+                path = os.path.join(SYSFS_PATH, name)
+                connector = SysfsConnector(path, name[len(prefix):])
+                connectors.append(connector)
+
+        return connectors
+
 class RenderNode(DeviceNode):
     def __init__(self, path):
         super().__init__(path)
@@ -1359,6 +3650,13 @@ def devices():
     directory = os.path.join(os.path.sep, 'dev', 'dri')
     result = []
 
+    # replaces the real devices with an in-process software device
+    if os.environ.get('DRM_SOFTWARE'):
+        from drm import software
+
+        outputs = software.parse_outputs(os.environ['DRM_SOFTWARE'])
+        return [ software.CardDevice('software', outputs) ]
+
     for name in os.listdir(directory):
         path = os.path.join(directory, name)
         device = None
@@ -1373,3 +3671,55 @@ def devices():
             result.append(device)
 
     return result
+
+def enumerate_device(node, probe = False):
+    device = node.open()
+
+    try:
+        device.info = device.version()
+        device.capabilities = {}
+
+        for cap in Capability:
+            try:
+                device.capabilities[cap] = device.get_capability(cap)
+            except OSError:
+                pass
+
+        if isinstance(node, CardDevice):
+            device.set_capability(ClientCapability.UNIVERSAL_PLANES, True)
+            device.get_resources(probe)
+    except:
+        device.close()
+        raise
+
+    return device
+
+# Open and enumerate device nodes concurrently. This is dominated by ioctls,
+# which release the GIL, so a thread pool parallelizes it well.
+def enumerate_all(nodes = None, max_workers = None, probe = False):
+    import concurrent.futures
+
+    if nodes is None:
+        nodes = devices()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(enumerate_device, node, probe) for node in nodes]
+
+    result = []
+    error = None
+
+    for future in futures:
+        try:
+            result.append(future.result())
+        except Exception as e:
+            if error is None:
+                error = e
+
+    # don't leak the devices that were opened successfully
+    if error is not None:
+        for device in result:
+            device.close()
+
+        raise error
+
+    return result
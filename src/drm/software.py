@@ -0,0 +1,931 @@
+#!/usr/bin/python3
+
+import ctypes, errno, fcntl, mmap, os, termios, threading, time
+import drm
+
+def address(pointer):
+    if isinstance(pointer, int):
+        return pointer
+
+    return ctypes.cast(pointer, ctypes.c_void_p).value or 0
+
+# copy values to a userspace array, but no more than it has room for
+def copy_out(pointer, ctype, values, count):
+    pointer = address(pointer)
+    count = min(count, len(values))
+
+    if pointer and count > 0:
+        array = (ctype * count).from_address(pointer)
+
+        for i in range(count):
+            array[i] = values[i]
+
+def copy_in(pointer, ctype, count):
+    pointer = address(pointer)
+
+    if not pointer or count == 0:
+        return []
+
+    return list((ctype * count).from_address(pointer))
+
+def create_mode(width, height, refresh):
+    mode = drm.mode_info()
+    mode.hdisplay = width
+    mode.hsync_start = width + 48
+    mode.hsync_end = width + 80
+    mode.htotal = width + 160
+    mode.vdisplay = height
+    mode.vsync_start = height + 3
+    mode.vsync_end = height + 8
+    mode.vtotal = height + 40
+    mode.vrefresh = refresh
+    mode.clock = mode.htotal * mode.vtotal * refresh // 1000
+    mode.flags = drm.MODE_FLAG_PHSYNC | drm.MODE_FLAG_NVSYNC
+    mode.type = drm.MODE_TYPE_DRIVER
+    mode.name = b'%ux%u' % (width, height)
+
+    return mode
+
+def create_edid(index):
+    edid = bytearray(128)
+    edid[0:8] = b'\x00\xff\xff\xff\xff\xff\xff\x00'
+    # manufacturer "PYD", product code and serial number
+    edid[8:10] = (0x4324).to_bytes(2, 'big')
+    edid[10] = index
+    edid[18:20] = b'\x01\x04'
+    edid[127] = -sum(edid[:127]) & 0xff
+
+    return bytes(edid)
+
+class Property:
+    def __init__(self, id, name, flags, values = None, enums = None):
+        self.id = id
+        self.name = name
+        self.flags = flags
+        self.values = values or []
+        self.enums = enums or []
+
+class Object:
+    def __init__(self, card, type):
+        self.id = card.allocate_id(self)
+        self.type = type
+        self.values = {}
+
+    def get(self, name):
+        return self.values[name]
+
+class CRTC(Object):
+    def __init__(self, card, index):
+        super().__init__(card, drm.MODE_OBJECT_CRTC)
+        self.index = index
+        self.mode = None
+        self.primary = None
+        self.flips = []
+        self.sequences = []
+
+        self.values['ACTIVE'] = 0
+        self.values['MODE_ID'] = 0
+
+    # duration of a frame with the current mode
+    def period(self, card):
+        refresh = 60
+
+        if self.mode is not None and self.mode.vrefresh:
+            refresh = self.mode.vrefresh
+
+        return int(1000000000 / (refresh * card.speed))
+
+class Encoder(Object):
+    def __init__(self, card, index, crtc):
+        super().__init__(card, drm.MODE_OBJECT_ENCODER)
+        self.index = index
+        self.crtc = crtc
+        self.possible_crtcs = 1 << crtc.index
+
+class Connector(Object):
+    def __init__(self, card, index, encoder, modes):
+        super().__init__(card, drm.MODE_OBJECT_CONNECTOR)
+        self.index = index
+        self.encoder = encoder
+        self.modes = modes
+
+        self.values['EDID'] = card.create_blob(create_edid(index))
+        self.values['DPMS'] = 0
+        self.values['CRTC_ID'] = encoder.crtc.id
+
+class Plane(Object):
+    PRIMARY = 1
+    CURSOR = 2
+    OVERLAY = 0
+
+    def __init__(self, card, crtc, type, formats):
+        super().__init__(card, drm.MODE_OBJECT_PLANE)
+        self.possible_crtcs = 1 << crtc.index
+        self.formats = formats
+        self.kind = type
+
+        self.values['type'] = type
+        self.values['FB_ID'] = 0
+        self.values['CRTC_ID'] = 0
+
+        for name in ('CRTC_X', 'CRTC_Y', 'CRTC_W', 'CRTC_H', 'SRC_X', 'SRC_Y', 'SRC_W', 'SRC_H'):
+            self.values[name] = 0
+
+class Buffer:
+    def __init__(self, handle, size):
+        self.handle = handle
+        self.size = size
+        self.offset = handle << 32
+        self.fd = os.memfd_create('dumb-%u' % handle, os.MFD_CLOEXEC)
+
+        os.ftruncate(self.fd, size)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class Framebuffer(Object):
+    def __init__(self, card, args):
+        super().__init__(card, drm.MODE_OBJECT_FB)
+        self.width = args.width
+        self.height = args.height
+        self.format = args.pixel_format
+        self.handles = list(args.handles)
+        self.pitches = list(args.pitches)
+        self.offsets = list(args.offsets)
+
+# Emulates a KMS device in-process. Dumb buffers are backed by memfds, and
+# page flip and sequence events are delivered at simulated vertical blanking
+# intervals through a pipe that takes the place of the device's file
+# descriptor. A speed greater than 1 runs the vblank clock faster than the
+# refresh rate of the modes.
+class Backend(drm.KernelBackend):
+    formats = [
+        drm.Format.XRGB8888, drm.Format.ARGB8888, drm.Format.XBGR8888,
+        drm.Format.ABGR8888, drm.Format.RGB565,
+    ]
+
+    capabilities = {
+        drm.Capability.DUMB_BUFFER: 1,
+        drm.Capability.VBLANK_HIGH_CRTC: 1,
+        drm.Capability.DUMB_PREFERRED_DEPTH: 24,
+        drm.Capability.DUMB_PREFER_SHADOW: 0,
+        drm.Capability.PRIME: 0,
+        drm.Capability.TIMESTAMP_MONOTONIC: 1,
+        drm.Capability.ASYNC_PAGE_FLIP: 0,
+        drm.Capability.CURSOR_WIDTH: 64,
+        drm.Capability.CURSOR_HEIGHT: 64,
+        drm.Capability.ADDFB2_MODIFIERS: 0,
+        drm.Capability.PAGE_FLIP_TARGET: 0,
+        drm.Capability.CRTC_IN_VBLANK_EVENT: 1,
+        drm.Capability.SYNCOBJ: 0,
+    }
+
+    # bytes of events that a client can have pending, as in the kernel
+    event_space = 4096
+
+    def __init__(self, outputs = ((1920, 1080, 60), ), speed = 1.0):
+        self.speed = speed
+        self.reserved = 0
+        self.objects = {}
+        self.properties = {}
+        self.blobs = {}
+        self.buffers = {}
+        self.next_handle = 1
+        self.universal_planes = False
+        self.atomic_enabled = False
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.start = time.monotonic_ns()
+
+        self.crtcs = []
+        self.encoders = []
+        self.connectors = []
+        self.planes = []
+        self.framebuffers = []
+
+        for name, flags, values, enums in [
+                ('type', drm.MODE_PROP_ENUM | drm.MODE_PROP_IMMUTABLE, [],
+                    [('Overlay', 0), ('Primary', 1), ('Cursor', 2)]),
+                ('FB_ID', drm.MODE_PROP_OBJECT | drm.MODE_PROP_ATOMIC, [drm.MODE_OBJECT_FB], []),
+                ('CRTC_ID', drm.MODE_PROP_OBJECT | drm.MODE_PROP_ATOMIC, [drm.MODE_OBJECT_CRTC], []),
+                ('CRTC_X', drm.MODE_PROP_SIGNED_RANGE | drm.MODE_PROP_ATOMIC, [-(1 << 31) & 0xffffffffffffffff, (1 << 31) - 1], []),
+                ('CRTC_Y', drm.MODE_PROP_SIGNED_RANGE | drm.MODE_PROP_ATOMIC, [-(1 << 31) & 0xffffffffffffffff, (1 << 31) - 1], []),
+                ('CRTC_W', drm.MODE_PROP_RANGE | drm.MODE_PROP_ATOMIC, [0, (1 << 31) - 1], []),
+                ('CRTC_H', drm.MODE_PROP_RANGE | drm.MODE_PROP_ATOMIC, [0, (1 << 31) - 1], []),
+                ('SRC_X', drm.MODE_PROP_RANGE | drm.MODE_PROP_ATOMIC, [0, (1 << 32) - 1], []),
+                ('SRC_Y', drm.MODE_PROP_RANGE | drm.MODE_PROP_ATOMIC, [0, (1 << 32) - 1], []),
+                ('SRC_W', drm.MODE_PROP_RANGE | drm.MODE_PROP_ATOMIC, [0, (1 << 32) - 1], []),
+                ('SRC_H', drm.MODE_PROP_RANGE | drm.MODE_PROP_ATOMIC, [0, (1 << 32) - 1], []),
+                ('ACTIVE', drm.MODE_PROP_RANGE | drm.MODE_PROP_ATOMIC, [0, 1], []),
+                ('MODE_ID', drm.MODE_PROP_BLOB | drm.MODE_PROP_ATOMIC, [], []),
+                ('EDID', drm.MODE_PROP_BLOB | drm.MODE_PROP_IMMUTABLE, [], []),
+                ('DPMS', drm.MODE_PROP_ENUM, [],
+                    [('On', 0), ('Standby', 1), ('Suspend', 2), ('Off', 3)])]:
+            prop = Property(self.allocate_id(None), name, flags, values, enums)
+            self.properties[name] = prop
+            self.objects[prop.id] = prop
+
+        for index, (width, height, refresh) in enumerate(outputs):
+            crtc = CRTC(self, index)
+            encoder = Encoder(self, index, crtc)
+            modes = [ create_mode(width, height, refresh) ]
+
+            # a few common lower resolutions as well
+            for w, h in ((1280, 720), (1024, 768), (640, 480)):
+                if w < width and h < height:
+                    modes.append(create_mode(w, h, 60))
+
+            modes[0].type |= drm.MODE_TYPE_PREFERRED
+            connector = Connector(self, index, encoder, modes)
+
+            self.crtcs.append(crtc)
+            self.encoders.append(encoder)
+            self.connectors.append(connector)
+
+            primary = Plane(self, crtc, Plane.PRIMARY, self.formats)
+            overlay = Plane(self, crtc, Plane.OVERLAY, self.formats)
+            cursor = Plane(self, crtc, Plane.CURSOR, [drm.Format.ARGB8888])
+            crtc.primary = primary
+
+            self.planes.extend([primary, overlay, cursor])
+
+            # start out like a console would have left things
+            self.set_mode(crtc, modes[0])
+            primary.values['CRTC_ID'] = crtc.id
+
+        for encoder in self.encoders:
+            encoder.possible_clones = 1 << encoder.index
+
+        self.handlers = {
+            drm.IOCTL_VERSION: self.version,
+            drm.IOCTL_GEM_CLOSE: self.gem_close,
+            drm.IOCTL_GET_CAP: self.get_cap,
+            drm.IOCTL_SET_CLIENT_CAP: self.set_client_cap,
+            drm.IOCTL_SET_MASTER: self.master,
+            drm.IOCTL_DROP_MASTER: self.master,
+            drm.IOCTL_CRTC_QUEUE_SEQUENCE: self.queue_sequence,
+            drm.IOCTL_MODE_GETRESOURCES: self.get_resources,
+            drm.IOCTL_MODE_GETCRTC: self.get_crtc,
+            drm.IOCTL_MODE_GETENCODER: self.get_encoder,
+            drm.IOCTL_MODE_GETCONNECTOR: self.get_connector,
+            drm.IOCTL_MODE_GETPROPERTY: self.get_property,
+            drm.IOCTL_MODE_GETPROPBLOB: self.get_blob,
+            drm.IOCTL_MODE_RMFB: self.rmfb,
+            drm.IOCTL_MODE_PAGE_FLIP: self.page_flip,
+            drm.IOCTL_MODE_CREATE_DUMB: self.create_dumb,
+            drm.IOCTL_MODE_MAP_DUMB: self.map_dumb,
+            drm.IOCTL_MODE_DESTROY_DUMB: self.destroy_dumb,
+            drm.IOCTL_MODE_GETPLANERESOURCES: self.get_plane_resources,
+            drm.IOCTL_MODE_GETPLANE: self.get_plane,
+            drm.IOCTL_MODE_SETPLANE: self.set_plane,
+            drm.IOCTL_MODE_ADDFB2: self.addfb2,
+            drm.IOCTL_MODE_OBJ_GETPROPERTIES: self.get_properties,
+            drm.IOCTL_MODE_ATOMIC: self.atomic,
+            drm.IOCTL_MODE_CREATEPROPBLOB: self.create_prop_blob,
+            drm.IOCTL_MODE_DESTROYPROPBLOB: self.destroy_prop_blob,
+        }
+
+    # like the kernel, hand out the lowest free ID, so that IDs are reused
+    def allocate_id(self, obj):
+        id = 1
+
+        while id in self.objects or id in self.blobs:
+            id += 1
+
+        if obj is not None:
+            self.objects[id] = obj
+
+        return id
+
+    def lookup(self, id, type):
+        obj = self.objects.get(id)
+
+        if obj is None or not isinstance(obj, Object) or obj.type != type:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+        return obj
+
+    def create_blob(self, data):
+        id = self.allocate_id(None)
+        self.blobs[id] = bytes(data)
+
+        return id
+
+    def set_mode(self, crtc, mode):
+        if crtc.values['MODE_ID']:
+            self.blobs.pop(crtc.values['MODE_ID'], None)
+
+        crtc.mode = mode
+
+        if mode is not None:
+            crtc.values['MODE_ID'] = self.create_blob(bytes(mode))
+            crtc.values['ACTIVE'] = 1
+        else:
+            crtc.values['MODE_ID'] = 0
+            crtc.values['ACTIVE'] = 0
+
+    def vblank_count(self, crtc, now):
+        return (now - self.start) // crtc.period(self)
+
+    def vblank_time(self, crtc, count):
+        return self.start + count * crtc.period(self)
+
+    def open(self, path):
+        self.events, self.writer = os.pipe2(os.O_CLOEXEC)
+        self.running = True
+        self.thread = threading.Thread(target = self.run, name = 'vblank', daemon = True)
+        self.thread.start()
+
+        return self.events
+
+    def close(self, fd):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+
+        self.thread.join()
+
+        for buffer in self.buffers.values():
+            buffer.close()
+
+        self.buffers = {}
+
+        os.close(self.writer)
+        os.close(self.events)
+
+    def ioctl(self, fd, nr, args):
+        handler = self.handlers.get(nr)
+
+        if handler is None:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        with self.lock:
+            handler(args)
+
+        return 0
+
+    def mmap(self, fd, offset, length, flags, prot, access):
+        for buffer in self.buffers.values():
+            if buffer.offset == offset:
+                return mmap.mmap(buffer.fd, length, flags, prot, access, 0)
+
+        raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+    # vblank clock, delivers events for all CRTCs at their next vblank. The
+    # events are written to the pipe without holding the lock, so a client
+    # that is slow to read them doesn't block other threads.
+    def run(self):
+        while True:
+            with self.lock:
+                events = []
+
+                while self.running and not events:
+                    now = time.monotonic_ns()
+                    deadline = None
+
+                    for crtc in self.crtcs:
+                        if crtc.flips or crtc.sequences:
+                            count = self.vblank_count(crtc, now)
+                            events.extend(self.complete(crtc, count))
+
+                        if crtc.flips or crtc.sequences:
+                            next = self.vblank_time(crtc, self.vblank_count(crtc, now) + 1)
+
+                            if deadline is None or next < deadline:
+                                deadline = next
+
+                    if events:
+                        break
+
+                    if deadline is None:
+                        self.lock.wait()
+                    else:
+                        self.lock.wait(max(deadline - time.monotonic_ns(), 0) / 1000000000)
+
+                if not self.running:
+                    return
+
+            for data in events:
+                os.write(self.writer, data)
+
+            with self.lock:
+                self.reserved -= sum(len(data) for data in events)
+
+    def complete(self, crtc, count):
+        events = []
+
+        for target, fb, user_data, event in list(crtc.flips):
+            if count >= target:
+                crtc.flips.remove((target, fb, user_data, event))
+
+                if fb is not None:
+                    crtc.primary.values['FB_ID'] = fb
+
+                if event:
+                    timestamp = self.vblank_time(crtc, target)
+                    ev = drm.event_vblank()
+                    ev.base.type = drm.EVENT_FLIP_COMPLETE
+                    ev.base.length = ctypes.sizeof(ev)
+                    ev.user_data = user_data
+                    ev.tv_sec = timestamp // 1000000000
+                    ev.tv_usec = timestamp % 1000000000 // 1000
+                    ev.sequence = target & 0xffffffff
+                    ev.crtc_id = crtc.id
+                    events.append(bytes(ev))
+
+        for target, user_data in list(crtc.sequences):
+            if count >= target:
+                crtc.sequences.remove((target, user_data))
+
+                ev = drm.event_crtc_sequence()
+                ev.base.type = drm.EVENT_CRTC_SEQUENCE
+                ev.base.length = ctypes.sizeof(ev)
+                ev.user_data = user_data
+                ev.time_ns = self.vblank_time(crtc, target)
+                ev.sequence = target
+                events.append(bytes(ev))
+
+        # wake up blocking commits
+        self.lock.notify_all()
+
+        return events
+
+    # Like the kernel, refuse to queue events that the client has no room for.
+    # Events that have been reserved always fit into the pipe, so writing them
+    # never blocks the vblank thread.
+    def reserve(self, size):
+        queued = ctypes.c_int()
+        fcntl.ioctl(self.events, termios.FIONREAD, queued)
+
+        if queued.value + self.reserved + size > self.event_space:
+            raise OSError(errno.ENOMEM, os.strerror(errno.ENOMEM))
+
+        self.reserved += size
+
+    def queue_flip(self, crtc, fb, user_data, event):
+        target = self.vblank_count(crtc, time.monotonic_ns()) + 1
+        flip = (target, fb, user_data, event)
+        crtc.flips.append(flip)
+        self.lock.notify_all()
+
+        return flip
+
+    def version(self, args):
+        args.version_major = 1
+        args.version_minor = 0
+        args.version_patchlevel = 0
+
+        for name, value in (('name', b'software'), ('date', b'20240101'),
+                            ('desc', b'Software KMS device')):
+            pointer = drm.read_pointer(args, name)
+            length = getattr(args, name + '_len')
+
+            if pointer and length > 0:
+                ctypes.memmove(pointer, value, min(length, len(value)))
+
+            setattr(args, name + '_len', len(value))
+
+    def get_cap(self, args):
+        value = self.capabilities.get(args.capability)
+
+        if value is None:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        args.value = value
+
+    def set_client_cap(self, args):
+        if args.capability == drm.ClientCapability.UNIVERSAL_PLANES:
+            self.universal_planes = bool(args.value)
+
+        # atomic clients always see all planes
+        if args.capability == drm.ClientCapability.ATOMIC:
+            self.atomic_enabled = bool(args.value)
+            self.universal_planes = bool(args.value)
+
+    # atomic properties are hidden from clients that haven't enabled atomic
+    def visible_properties(self, obj):
+        return [(name, value) for name, value in obj.values.items()
+                if self.atomic_enabled or not self.properties[name].flags & drm.MODE_PROP_ATOMIC]
+
+    def master(self, args):
+        pass
+
+    def get_resources(self, args):
+        ids = [
+            ('fb_id_ptr', 'count_fbs', [fb.id for fb in self.framebuffers]),
+            ('crtc_id_ptr', 'count_crtcs', [crtc.id for crtc in self.crtcs]),
+            ('connector_id_ptr', 'count_connectors', [c.id for c in self.connectors]),
+            ('encoder_id_ptr', 'count_encoders', [e.id for e in self.encoders]),
+        ]
+
+        for pointer, count, values in ids:
+            copy_out(getattr(args, pointer), ctypes.c_uint32, values, getattr(args, count))
+            setattr(args, count, len(values))
+
+        args.min_width = args.min_height = 1
+        args.max_width = args.max_height = 8192
+
+    def get_crtc(self, args):
+        crtc = self.lookup(args.crtc_id, drm.MODE_OBJECT_CRTC)
+
+        args.fb_id = crtc.primary.values['FB_ID']
+        args.x = crtc.primary.values['SRC_X'] >> 16
+        args.y = crtc.primary.values['SRC_Y'] >> 16
+        args.gamma_size = 0
+
+        if crtc.mode is not None:
+            args.mode_valid = 1
+            args.mode = crtc.mode
+        else:
+            args.mode_valid = 0
+
+    def get_encoder(self, args):
+        encoder = self.lookup(args.encoder_id, drm.MODE_OBJECT_ENCODER)
+
+        args.encoder_type = drm.MODE_ENCODER_VIRTUAL
+        args.crtc_id = encoder.crtc.id
+        args.possible_crtcs = encoder.possible_crtcs
+        args.possible_clones = encoder.possible_clones
+
+    def get_connector(self, args):
+        connector = self.lookup(args.connector_id, drm.MODE_OBJECT_CONNECTOR)
+        properties = self.visible_properties(connector)
+
+        if args.count_modes >= len(connector.modes):
+            copy_out(args.modes_ptr, drm.mode_info, connector.modes, args.count_modes)
+
+        if args.count_encoders >= 1:
+            copy_out(args.encoders_ptr, ctypes.c_uint32, [connector.encoder.id], args.count_encoders)
+
+        copy_out(args.props_ptr, ctypes.c_uint32,
+                 [self.properties[name].id for name, _ in properties], args.count_props)
+        copy_out(args.prop_values_ptr, ctypes.c_uint64,
+                 [value for _, value in properties], args.count_props)
+
+        args.count_modes = len(connector.modes)
+        args.count_encoders = 1
+        args.count_props = len(properties)
+        args.encoder_id = connector.encoder.id
+        args.connector_type = drm.MODE_CONNECTOR_VIRTUAL
+        args.connector_type_id = connector.index + 1
+        args.connection = drm.Connector.Status.CONNECTED
+        args.mm_width = connector.modes[0].hdisplay * 254 // 960
+        args.mm_height = connector.modes[0].vdisplay * 254 // 960
+        args.subpixel = 0
+
+    def get_property(self, args):
+        prop = self.objects.get(args.prop_id)
+
+        if not isinstance(prop, Property):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+        args.name = prop.name.encode()
+        args.flags = prop.flags
+
+        if prop.enums:
+            values = [value for _, value in prop.enums]
+
+            if args.count_values >= len(values):
+                copy_out(args.values_ptr, ctypes.c_uint64, values, args.count_values)
+
+            if args.count_enum_blobs >= len(prop.enums):
+                enums = []
+
+                for name, value in prop.enums:
+                    enum = drm.mode_property_enum()
+                    enum.name = name.encode()
+                    enum.value = value
+                    enums.append(enum)
+
+                copy_out(args.enum_blob_ptr, drm.mode_property_enum, enums, args.count_enum_blobs)
+
+            args.count_values = len(values)
+            args.count_enum_blobs = len(prop.enums)
+        else:
+            if args.count_values >= len(prop.values):
+                copy_out(args.values_ptr, ctypes.c_uint64, prop.values, args.count_values)
+
+            args.count_values = len(prop.values)
+            args.count_enum_blobs = 0
+
+    def get_blob(self, args):
+        data = self.blobs.get(args.blob_id)
+
+        if data is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+        pointer = address(args.data)
+
+        if pointer and args.length >= len(data):
+            ctypes.memmove(pointer, data, len(data))
+
+        args.length = len(data)
+
+    def create_prop_blob(self, args):
+        if args.length == 0:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        args.blob_id = self.create_blob(ctypes.string_at(args.data, args.length))
+
+    def destroy_prop_blob(self, args):
+        if self.blobs.pop(args.blob_id, None) is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+    def get_properties(self, args):
+        obj = self.objects.get(args.obj_id)
+
+        if not isinstance(obj, Object) or (args.obj_type and obj.type != args.obj_type):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+        properties = self.visible_properties(obj)
+
+        copy_out(args.props_ptr, ctypes.c_uint32,
+                 [self.properties[name].id for name, _ in properties], args.count_props)
+        copy_out(args.prop_values_ptr, ctypes.c_uint64,
+                 [value for _, value in properties], args.count_props)
+
+        args.count_props = len(properties)
+
+    def get_plane_resources(self, args):
+        planes = [plane.id for plane in self.planes
+                  if self.universal_planes or plane.kind == Plane.OVERLAY]
+
+        copy_out(args.plane_id_ptr, ctypes.c_uint32, planes, args.count_planes)
+        args.count_planes = len(planes)
+
+    def get_plane(self, args):
+        plane = self.lookup(args.plane_id, drm.MODE_OBJECT_PLANE)
+
+        if args.count_format_types >= len(plane.formats):
+            copy_out(args.format_type_ptr, ctypes.c_uint32, plane.formats,
+                     args.count_format_types)
+
+        args.crtc_id = plane.values['CRTC_ID']
+        args.fb_id = plane.values['FB_ID']
+        args.possible_crtcs = plane.possible_crtcs
+        args.gamma_size = 0
+        args.count_format_types = len(plane.formats)
+
+    def set_plane(self, args):
+        plane = self.lookup(args.plane_id, drm.MODE_OBJECT_PLANE)
+
+        if args.fb_id == 0:
+            plane.values['FB_ID'] = 0
+            plane.values['CRTC_ID'] = 0
+            return
+
+        crtc = self.lookup(args.crtc_id, drm.MODE_OBJECT_CRTC)
+        fb = self.lookup(args.fb_id, drm.MODE_OBJECT_FB)
+
+        if not plane.possible_crtcs & (1 << crtc.index) or fb.format not in plane.formats:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        for name in ('CRTC_X', 'CRTC_Y', 'CRTC_W', 'CRTC_H', 'SRC_X', 'SRC_Y', 'SRC_W', 'SRC_H'):
+            plane.values[name] = getattr(args, name.lower()) & 0xffffffff
+
+        plane.values['FB_ID'] = fb.id
+        plane.values['CRTC_ID'] = crtc.id
+
+    def create_dumb(self, args):
+        if args.width == 0 or args.height == 0 or args.bpp == 0:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        pitch = (args.width * ((args.bpp + 7) // 8) + 63) & ~63
+        size = (pitch * args.height + mmap.PAGESIZE - 1) & ~(mmap.PAGESIZE - 1)
+        buffer = Buffer(self.next_handle, size)
+        self.next_handle += 1
+        self.buffers[buffer.handle] = buffer
+
+        args.handle = buffer.handle
+        args.pitch = pitch
+        args.size = size
+
+    def map_dumb(self, args):
+        buffer = self.buffers.get(args.handle)
+
+        if buffer is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+        args.offset = buffer.offset
+
+    def destroy_dumb(self, args):
+        buffer = self.buffers.pop(args.handle, None)
+
+        if buffer is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+        buffer.close()
+
+    def gem_close(self, args):
+        self.destroy_dumb(args)
+
+    def addfb2(self, args):
+        try:
+            fmt = drm.Format(args.pixel_format)
+        except ValueError:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        for i in range(fmt.num_planes):
+            buffer = self.buffers.get(args.handles[i])
+            hsub = fmt.hsub if i > 0 else 1
+            vsub = fmt.vsub if i > 0 else 1
+            length = args.offsets[i] + args.pitches[i] * (args.height // vsub)
+
+            if buffer is None:
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+            if args.pitches[i] < args.width // hsub * fmt.cpp[i] or length > buffer.size:
+                raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        fb = Framebuffer(self, args)
+        self.framebuffers.append(fb)
+        args.fb_id = fb.id
+
+    def rmfb(self, args):
+        fb = self.lookup(args.value, drm.MODE_OBJECT_FB)
+
+        # framebuffers that are being scanned out are disabled first
+        for plane in self.planes:
+            if plane.values['FB_ID'] == fb.id:
+                plane.values['FB_ID'] = 0
+                plane.values['CRTC_ID'] = 0
+
+        for crtc in self.crtcs:
+            for flip in [flip for flip in crtc.flips if flip[1] == fb.id]:
+                crtc.flips.remove(flip)
+
+                if flip[3]:
+                    self.reserved -= ctypes.sizeof(drm.event_vblank)
+
+        self.framebuffers.remove(fb)
+        del self.objects[fb.id]
+
+    def page_flip(self, args):
+        crtc = self.lookup(args.crtc_id, drm.MODE_OBJECT_CRTC)
+        fb = self.lookup(args.fb_id, drm.MODE_OBJECT_FB)
+
+        if args.flags & ~drm.PageFlip.EVENT:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        if crtc.mode is None:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        if not crtc.primary.values['FB_ID'] or crtc.flips:
+            raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+
+        if args.flags & drm.PageFlip.EVENT:
+            self.reserve(ctypes.sizeof(drm.event_vblank))
+
+        self.queue_flip(crtc, fb.id, args.user_data, args.flags & drm.PageFlip.EVENT)
+
+    def queue_sequence(self, args):
+        crtc = self.lookup(args.crtc_id, drm.MODE_OBJECT_CRTC)
+        current = self.vblank_count(crtc, time.monotonic_ns())
+        target = args.sequence
+
+        if crtc.mode is None:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        if args.flags & drm.Sequence.RELATIVE:
+            target += current
+
+        if args.flags & drm.Sequence.NEXT_ON_MISS and target <= current:
+            target = current + 1
+
+        self.reserve(ctypes.sizeof(drm.event_crtc_sequence))
+        crtc.sequences.append((target, args.user_data))
+        args.sequence = target
+        self.lock.notify_all()
+
+    # whether changing a property requires a full modeset
+    def is_modeset(self, obj, name, value):
+        if isinstance(obj, CRTC) and name == 'MODE_ID':
+            if obj.mode is None:
+                return bool(value)
+
+            return self.blobs.get(value) != bytes(obj.mode)
+
+        if isinstance(obj, CRTC) and name == 'ACTIVE' or \
+           isinstance(obj, Connector) and name == 'CRTC_ID':
+            return value != obj.values[name]
+
+        return False
+
+    def atomic(self, args):
+        objs = copy_in(args.objs_ptr, ctypes.c_uint32, args.count_objs)
+        counts = copy_in(args.count_props_ptr, ctypes.c_uint32, args.count_objs)
+        total = sum(counts)
+        props = copy_in(args.props_ptr, ctypes.c_uint32, total)
+        values = copy_in(args.prop_values_ptr, ctypes.c_uint64, total)
+        names = { prop.id: name for name, prop in self.properties.items() }
+        changes = []
+        crtcs = set()
+        index = 0
+
+        if not self.atomic_enabled:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        for obj_id, count in zip(objs, counts):
+            obj = self.objects.get(obj_id)
+
+            if not isinstance(obj, Object):
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+
+            for prop_id, value in zip(props[index:index + count], values[index:index + count]):
+                name = names.get(prop_id)
+
+                if name not in obj.values or self.properties[name].flags & drm.MODE_PROP_IMMUTABLE:
+                    raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+                if name == 'FB_ID' and value:
+                    self.lookup(value, drm.MODE_OBJECT_FB)
+
+                if name == 'CRTC_ID' and value:
+                    crtcs.add(self.lookup(value, drm.MODE_OBJECT_CRTC))
+
+                if name == 'MODE_ID' and value and value not in self.blobs:
+                    raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+                if self.is_modeset(obj, name, value) and not args.flags & drm.Atomic.ALLOW_MODESET:
+                    raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+                if isinstance(obj, CRTC):
+                    crtcs.add(obj)
+                elif isinstance(obj, Plane) and obj.values['CRTC_ID']:
+                    crtcs.add(self.objects[obj.values['CRTC_ID']])
+
+                changes.append((obj, name, value))
+
+            index += count
+
+        # there would be nothing to send the event for
+        if args.flags & drm.Atomic.PAGE_FLIP_EVENT and not crtcs:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        if args.flags & drm.Atomic.TEST_ONLY:
+            return
+
+        # blocking commits wait for earlier commits to complete instead
+        if args.flags & drm.Atomic.NONBLOCK:
+            if any(crtc.flips for crtc in crtcs):
+                raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+        else:
+            while any(crtc.flips for crtc in crtcs):
+                self.lock.wait()
+
+        if args.flags & drm.Atomic.PAGE_FLIP_EVENT:
+            self.reserve(len(crtcs) * ctypes.sizeof(drm.event_vblank))
+
+        for obj, name, value in changes:
+            if name == 'MODE_ID':
+                mode = None
+
+                if value:
+                    mode = drm.mode_info.from_buffer_copy(self.blobs[value])
+
+                obj.mode = mode
+                obj.values['MODE_ID'] = value
+            else:
+                obj.values[name] = value
+
+        # changes become visible at the next vblank
+        flips = []
+
+        for crtc in crtcs:
+            flip = self.queue_flip(crtc, None, args.user_data,
+                                   args.flags & drm.Atomic.PAGE_FLIP_EVENT)
+            flips.append((crtc, flip))
+
+        if not args.flags & drm.Atomic.NONBLOCK:
+            while any(flip in crtc.flips for crtc, flip in flips):
+                self.lock.wait()
+
+# selected instead of the real device nodes through DRM_SOFTWARE, which lists
+# the outputs, e.g. "1920x1080@60,1280x720@60" (or "1" for a single output)
+def parse_outputs(spec):
+    outputs = []
+
+    for output in spec.split(','):
+        output = output.strip()
+
+        if not output or output == '1':
+            outputs.append((1920, 1080, 60))
+            continue
+
+        resolution, _, refresh = output.partition('@')
+        width, height = resolution.split('x')
+        outputs.append((int(width), int(height), int(refresh or 60)))
+
+    return outputs
+
+class CardDevice(drm.CardDevice):
+    def __init__(self, path, outputs = ((1920, 1080, 60), ), speed = 1.0):
+        super().__init__(path)
+        self.outputs = outputs
+        self.speed = speed
+
+    def open(self):
+        return drm.Device(self.path, Backend(self.outputs, self.speed))
@@ -366,9 +366,12 @@ class Job:
             args.syncpt.increments = self.syncpt.increments
             args.syncpt.flags = 0
 
-        self.ioctl(DRM_IOCTL_TEGRA_CHANNEL_SUBMIT, args)
+        with drm.trace('Job.submit', 'tegra', { 'words': args.gather_data_words }) as span:
+            self.ioctl(DRM_IOCTL_TEGRA_CHANNEL_SUBMIT, args)
 
-        self.fence = args.syncpt.value
+            self.fence = args.syncpt.value
+            span.set('syncpoint', args.syncpt.id)
+            span.set('fence', self.fence)
 
     def wait(self, timeout):
         now = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
@@ -378,7 +381,8 @@ class Job:
         args.id = self.syncpt.id
         args.threshold = self.fence
 
-        self.ioctl(DRM_IOCTL_TEGRA_SYNCPOINT_WAIT, args)
+        with drm.trace('Job.wait', 'tegra', { 'syncpoint': args.id, 'threshold': args.threshold }):
+            self.ioctl(DRM_IOCTL_TEGRA_SYNCPOINT_WAIT, args)
 
 class Channel:
     class Class(enum.IntEnum):
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+
+import argparse, json, platform, statistics, sys, time
+import drm, drm.software
+
+# Benchmarks run against the software KMS device, so no hardware is needed
+# and results are comparable between machines of the same kind. Each round
+# calls a benchmark often enough to take at least --min-time, and the time
+# per call is recorded. Benchmarks that have a setup function need fresh
+# state for every call, so each call is timed on its own and the setup is
+# left out of the measurement.
+#
+# Run this as "python -m drm.tools.benchmark". Running the script from this
+# directory would import drm.py here instead of the drm package.
+class Benchmark:
+    def __init__(self, name, function, setup = None):
+        self.name = name
+        self.function = function
+        self.setup = setup
+
+    def measure(self, iterations):
+        if self.setup is None:
+            start = time.perf_counter()
+
+            for i in range(iterations):
+                self.function()
+
+            return time.perf_counter() - start
+
+        duration = 0
+
+        for i in range(iterations):
+            self.setup()
+
+            start = time.perf_counter()
+            self.function()
+            duration += time.perf_counter() - start
+
+        return duration
+
+    def calibrate(self, min_time):
+        iterations = 1
+
+        while True:
+            duration = self.measure(iterations)
+
+            if duration >= min_time:
+                return iterations
+
+            iterations *= 10 if duration < min_time / 10 else 2
+
+    def run(self, rounds, min_time, warmup):
+        for i in range(warmup):
+            if self.setup is not None:
+                self.setup()
+
+            self.function()
+
+        iterations = self.calibrate(min_time)
+        times = []
+
+        for i in range(rounds):
+            times.append(self.measure(iterations) / iterations)
+
+        return {
+            'min': min(times),
+            'max': max(times),
+            'mean': statistics.mean(times),
+            'median': statistics.median(times),
+            'stddev': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'rounds': rounds,
+            'iterations': iterations,
+        }
+
+def open_device(outputs):
+    device = drm.Device('software', drm.software.Backend(outputs))
+    device.enable_atomic()
+    device.get_resources()
+
+    return device
+
+def resources(name, outputs, lazy = False):
+    device = open_device(outputs)
+
+    # start from empty caches, as a freshly opened device would
+    def setup():
+        device.property_cache = {}
+        device.blob_cache = drm.BlobCache()
+
+    def function():
+        device.get_resources(lazy = lazy)
+
+    return Benchmark(name, function, setup), device
+
+def properties(device):
+    plane = device.planes[0]
+    values = device.get_property_values(drm.MODE_OBJECT_PLANE, plane.id)
+    edid = [prop for prop in device.connectors[0].properties if prop.name == 'EDID'][0]
+
+    def get_property():
+        for prop, value in values:
+            device.get_property(prop, value)
+
+    def get_blob():
+        device.get_blob(edid.blob.id, True)
+
+    def setup():
+        device.blob_cache = drm.BlobCache()
+
+    return [
+        Benchmark('property.get', get_property),
+        Benchmark('blob.get', get_blob),
+        Benchmark('blob.get.cold', get_blob, setup),
+    ]
+
+def pixels(width, height):
+    fmt = drm.Format.XRGB8888
+    benchmarks = [
+        Benchmark('format.pixel', lambda: fmt.pixel(1.0, 0.5, 0.25, 1.0)),
+    ]
+
+    try:
+        import numpy
+    except ImportError:
+        print('numpy not available, skipping bulk pixel benchmarks', file = sys.stderr)
+        return benchmarks
+
+    rgba = numpy.full((height, width, 4), 128, dtype = numpy.uint8)
+    packed = fmt.pack(rgba)
+
+    benchmarks.extend([
+        Benchmark('format.pack', lambda: fmt.pack(rgba)),
+        Benchmark('format.unpack', lambda: fmt.unpack(packed)),
+    ])
+
+    return benchmarks
+
+def buffers(device, width, height):
+    fmt = drm.Format.XRGB8888
+    pixel = fmt.pixel(1.0, 0.5, 0.25, 1.0)
+    src = device.create_dumb(width, height, fmt.cpp[0] * 8, 0)
+    dst = device.create_dumb(width, height, fmt.cpp[0] * 8, 0)
+    data = bytes(width * height * fmt.cpp[0])
+
+    src.map()
+    dst.map()
+
+    def add_framebuffer():
+        fb = device.add_framebuffer(width, height, fmt, 0, src, src.pitch, 0, 0)
+        fb.close()
+
+    return [
+        Benchmark('dumb.fill', lambda: dst.fill(pixel)),
+        Benchmark('dumb.fill_rect', lambda: dst.fill_rect(1, 1, width - 2, height - 2, pixel)),
+        Benchmark('dumb.copy_rect', lambda: dst.copy_rect(src, 0, 0, 0, 0, width, height)),
+        Benchmark('dumb.write_rows', lambda: dst.write_rows(0, data)),
+        Benchmark('framebuffer.add', add_framebuffer),
+    ], [src, dst]
+
+def compare(results, baseline, stat, threshold):
+    regressions = []
+
+    print()
+    print('%-24s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'change'))
+
+    for name, result in results.items():
+        if name not in baseline:
+            print('%-24s %12s %12s %8s' % (name, '-', format_time(result[stat]), 'new'))
+            continue
+
+        before = baseline[name][stat]
+        after = result[stat]
+        change = (after - before) / before * 100 if before else 0.0
+        marker = ''
+
+        if change > threshold:
+            regressions.append(name)
+            marker = ' REGRESSION'
+
+        print('%-24s %12s %12s %+7.1f%%%s' % (name, format_time(before), format_time(after),
+                                             change, marker))
+
+    return regressions
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.3f %s' % (seconds / scale, unit)
+
+    return '%.1f ns' % (seconds / 1e-9)
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m drm.tools.benchmark')
+    parser.add_argument('--rounds', type = int, default = 20,
+                        help = 'number of timed rounds per benchmark')
+    parser.add_argument('--warmup', type = int, default = 2,
+                        help = 'number of untimed calls before measuring')
+    parser.add_argument('--min-time', type = float, default = 0.01,
+                        help = 'minimum duration of a round in seconds')
+    parser.add_argument('--filter', metavar = 'PATTERN',
+                        help = 'only run benchmarks whose name contains PATTERN')
+    parser.add_argument('--output', metavar = 'FILE',
+                        help = 'write results as JSON to FILE')
+    parser.add_argument('--compare', metavar = 'FILE',
+                        help = 'compare results against a baseline written by --output')
+    parser.add_argument('--stat', choices = ('min', 'median', 'mean'), default = 'min',
+                        help = 'statistic to use for comparisons')
+    parser.add_argument('--threshold', type = float, default = 10.0,
+                        help = 'fail if a benchmark is slower by more than this percentage')
+    args = parser.parse_args(sys.argv[1:])
+
+    width, height = 1920, 1080
+    small = [ (width, height, 60) ]
+    large = [ (width, height, 60) ] * 16
+
+    benchmark, device = resources('resources.small', small)
+    benchmarks = [ benchmark ]
+    devices = [ device ]
+
+    for name, lazy in (('resources.large', False), ('resources.large.lazy', True)):
+        benchmark, device = resources(name, large, lazy)
+        benchmarks.append(benchmark)
+        devices.append(device)
+
+    device = open_device(small)
+    devices.append(device)
+
+    benchmarks.extend(properties(device))
+    benchmarks.extend(pixels(width, height))
+
+    dumbs, objects = buffers(device, width, height)
+    benchmarks.extend(dumbs)
+
+    if args.filter:
+        benchmarks = [b for b in benchmarks if args.filter in b.name]
+
+    results = {}
+
+    for benchmark in benchmarks:
+        result = benchmark.run(args.rounds, args.min_time, args.warmup)
+        results[benchmark.name] = result
+
+        print('%-24s %12s  (median %s, stddev %s, %u x %u)' % (benchmark.name,
+              format_time(result['min']), format_time(result['median']),
+              format_time(result['stddev']), result['rounds'], result['iterations']))
+
+    for obj in objects:
+        obj.close()
+
+    for device in devices:
+        device.close()
+
+    if args.output:
+        report = {
+            'machine': {
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'machine': platform.machine(),
+                'system': platform.system(),
+            },
+            'time': time.time(),
+            'benchmarks': results,
+        }
+
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent = 2)
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline:
+            baseline = json.load(baseline)['benchmarks']
+
+        regressions = compare(results, baseline, args.stat, args.threshold)
+
+        if regressions:
+            print('%u benchmark(s) regressed by more than %.1f%%: %s' %
+                  (len(regressions), args.threshold, ', '.join(regressions)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
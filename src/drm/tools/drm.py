@@ -42,7 +42,7 @@ def main():
             print('  Sync objects:', device.get_capability(drm.CAP_SYNCOBJ))
 
             device.set_capability(drm.CLIENT_CAP_UNIVERSAL_PLANES, True)
-            device.get_resources()
+            device.get_resources(probe = True)
 
             if device.connectors:
                 print('connectors:')
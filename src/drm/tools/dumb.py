@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 
-import argparse, enum, sys, time
+import argparse, asyncio, enum, sys
 import drm, utils
 
 class Backend(enum.Enum):
@@ -10,6 +10,72 @@ class Backend(enum.Enum):
     def __str__(self):
         return self._value_
 
+def draw(args, dumb, fmt, color):
+    width, height = dumb.width, dumb.height
+
+    if args.backend == Backend.CAIRO:
+        import cairo
+
+        data = dumb.map()
+
+        if fmt == drm.Format.ARGB8888:
+            crfmt = cairo.FORMAT_ARGB32
+        elif fmt == drm.Format.XRGB8888:
+            crfmt = cairo.FORMAT_RGB24
+        elif fmt == drm.Format.RGB565:
+            crfmt = cairo.FORMAT_RGB16_565
+        else:
+            raise Exception('format %s not supported in cairo backend' % fmt)
+
+        surface = cairo.ImageSurface.create_for_data(data, crfmt, width, height,
+                                                     dumb.pitch)
+        cr = cairo.Context(surface)
+        cr.scale(width, height)
+
+        cr.rectangle(0, 0, 1, 1)
+        cr.set_source_rgba(*color)
+        cr.fill()
+
+        del cr, surface
+    else:
+        pixel = fmt.pixel(*color)
+        dumb.fill(pixel)
+
+async def show(args, device, connector):
+    mode = connector.modes[0]
+    width = mode.hdisplay
+    height = mode.vdisplay
+    crtc = connector.encoder.crtc
+
+    #fmt = drm.Format.ARGB8888
+    #fmt = drm.Format.XRGB8888
+    #fmt = drm.Format.RGB565
+    fmt = args.format
+
+    for plane in device.planes:
+        if plane.crtc == crtc:
+            break
+    else:
+        plane = None
+
+    swapchain = drm.Swapchain(device, crtc, width, height, fmt, plane = plane)
+
+    white = (1.0, 1.0, 1.0, 1.0)
+    red = (1.0, 0.0, 0.0, 1.0)
+    green = (0.0, 1.0, 0.0, 1.0)
+    blue = (0.0, 0.0, 1.0, 1.0)
+
+    for color in [ white, red, green, blue ]:
+        buffer = await swapchain.acquire()
+        with drm.trace('draw', 'render', { 'backend': str(args.backend) }):
+            draw(args, buffer.dumb, fmt, color)
+        await swapchain.present(buffer)
+
+        await asyncio.sleep(1)
+
+    await swapchain.wait()
+    swapchain.close()
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--backend', metavar = 'BACKEND', type = Backend, default = Backend.CAIRO,
@@ -17,81 +83,31 @@ def main():
     parser.add_argument('--format', metavar = 'FORMAT', type = drm.Format,
                         default = drm.Format.ARGB8888,
                         action = utils.StoreEnumAction)
+    parser.add_argument('--trace', metavar = 'FILE',
+                        help = 'write a Chrome trace of the session to FILE')
     args = parser.parse_args(sys.argv[1:])
 
+    if args.trace:
+        trace = drm.start_tracing()
+
     for node in drm.devices():
         if isinstance(node, drm.CardDevice):
             device = node.open()
 
             device.set_capability(drm.ClientCapability.UNIVERSAL_PLANES, True)
-            device.get_resources()
+            device.get_resources(lazy = True)
 
             if device.connectors:
                 for connector in device.connectors:
                     if connector.status == drm.Connector.Status.CONNECTED:
-                        mode = connector.modes[0]
-                        width = mode.hdisplay
-                        height = mode.vdisplay
-
-                        #fmt = drm.Format.ARGB8888
-                        #fmt = drm.Format.XRGB8888
-                        #fmt = drm.Format.RGB565
-                        fmt = args.format
-
-                        dumb = device.create_dumb(width, height, fmt.cpp[0] * 8, 0)
-
-                        fb = device.add_framebuffer(width, height, fmt, 0,
-                                                    dumb, dumb.pitch, 0, 0)
-
-                        for plane in device.planes:
-                            if plane.crtc == connector.encoder.crtc:
-                                plane.set(plane.crtc, fb, 0, 0, 0, width, height, 0, 0, width, height)
-
-                        if args.backend == Backend.CAIRO:
-                            import cairo
-
-                            data = dumb.map()
-
-                            if fmt == drm.Format.ARGB8888:
-                                crfmt = cairo.FORMAT_ARGB32
-                            elif fmt == drm.Format.XRGB8888:
-                                crfmt = cairo.FORMAT_RGB24
-                            elif fmt == drm.Format.RGB565:
-                                crfmt = cairo.FORMAT_RGB16_565
-                            else:
-                                raise Exception('format %s not supported in cairo backend' % fmt)
-
-                            pitch = crfmt.stride_for_width(width)
-                            surface = cairo.ImageSurface.create_for_data(data, crfmt, width,
-                                                                         height, pitch)
-                            cr = cairo.Context(surface)
-                            cr.scale(width, height)
-
-                            white = (1.0, 1.0, 1.0, 1.0)
-                            red = (1.0, 0.0, 0.0, 1.0)
-                            green = (0.0, 1, 0.0, 1.0)
-                            blue = (0.0, 0.0, 1.0, 1.0)
-
-                            for color in [ white, red, green, blue ]:
-                                cr.rectangle(0, 0, 1, 1)
-                                cr.set_source_rgba(*color)
-                                cr.fill()
-
-                                time.sleep(1)
-
-                            del cr, surface
-                        else:
-                            white = fmt.pixel(1.0, 1.0, 1.0, 1.0)
-                            red = fmt.pixel(1.0, 0.0, 0.0, 1.0)
-                            green = fmt.pixel(0.0, 1.0, 0.0, 1.0)
-                            blue = fmt.pixel(0.0, 0.0, 1.0, 1.0)
-
-                            for pixel in [ white, red, green, blue ]:
-                                for y in range(0, height):
-                                    for x in range(0, width):
-                                        dumb[x, y] = pixel
-
-                                time.sleep(1)
+                        if not connector.modes:
+                            connector.probe()
+
+                        asyncio.run(show(args, device, connector))
+
+    if args.trace:
+        drm.stop_tracing()
+        trace.flush(args.trace)
 
 if __name__ == '__main__':
     main()
@@ -3,10 +3,15 @@
 import ctypes, drm
 
 def main():
-    for node in drm.devices():
+    nodes = drm.devices()
+    cards = [node for node in nodes if isinstance(node, drm.CardDevice)]
+    devices = dict(zip(cards, drm.enumerate_all(cards, probe = True)))
+
+    for node in nodes:
         if isinstance(node, drm.CardDevice):
-            device = node.open()
-            v = device.version()
+            device = devices[node]
+            caps = device.capabilities
+            v = device.info
 
             print('version: %u.%u.%u' % (v.major, v.minor, v.patch))
             print('name:', v.name)
@@ -14,12 +19,12 @@ def main():
             print('description:', v.desc)
 
             print('capabilities:')
-            print('  dumb buffers:', device.get_capability(drm.Capability.DUMB_BUFFER))
-            print('  VBLANK high CRTC:', device.get_capability(drm.Capability.VBLANK_HIGH_CRTC))
-            print('  preferred depth:', device.get_capability(drm.Capability.DUMB_PREFERRED_DEPTH))
-            print('  prefer shadow:', device.get_capability(drm.Capability.DUMB_PREFER_SHADOW))
+            print('  dumb buffers:', caps.get(drm.Capability.DUMB_BUFFER, 0))
+            print('  VBLANK high CRTC:', caps.get(drm.Capability.VBLANK_HIGH_CRTC, 0))
+            print('  preferred depth:', caps.get(drm.Capability.DUMB_PREFERRED_DEPTH, 0))
+            print('  prefer shadow:', caps.get(drm.Capability.DUMB_PREFER_SHADOW, 0))
 
-            prime = device.get_capability(drm.Capability.PRIME)
+            prime = caps.get(drm.Capability.PRIME, 0)
             flags = []
 
             if prime & drm.Prime.IMPORT:
@@ -30,20 +35,17 @@ def main():
 
             print('  PRIME:', ', '.join(flags))
             #print('  PRIME:', drm.Prime(prime))
-            print('  timestamp monotonic:', device.get_capability(drm.Capability.TIMESTAMP_MONOTONIC))
-            print('  async page flip:', device.get_capability(drm.Capability.ASYNC_PAGE_FLIP))
+            print('  timestamp monotonic:', caps.get(drm.Capability.TIMESTAMP_MONOTONIC, 0))
+            print('  async page flip:', caps.get(drm.Capability.ASYNC_PAGE_FLIP, 0))
 
-            width = device.get_capability(drm.Capability.CURSOR_WIDTH)
-            height = device.get_capability(drm.Capability.CURSOR_HEIGHT)
+            width = caps.get(drm.Capability.CURSOR_WIDTH, 0)
+            height = caps.get(drm.Capability.CURSOR_HEIGHT, 0)
             print('  cursor: %ux%u' % (width, height))
 
-            print('  framebuffer modifiers:', device.get_capability(drm.Capability.ADDFB2_MODIFIERS))
-            print('  page flip target:', device.get_capability(drm.Capability.PAGE_FLIP_TARGET))
-            print('  CRTC in VBLANK event:', device.get_capability(drm.Capability.CRTC_IN_VBLANK_EVENT))
-            print('  Sync objects:', device.get_capability(drm.Capability.SYNCOBJ))
-
-            device.set_capability(drm.ClientCapability.UNIVERSAL_PLANES, True)
-            device.get_resources()
+            print('  framebuffer modifiers:', caps.get(drm.Capability.ADDFB2_MODIFIERS, 0))
+            print('  page flip target:', caps.get(drm.Capability.PAGE_FLIP_TARGET, 0))
+            print('  CRTC in VBLANK event:', caps.get(drm.Capability.CRTC_IN_VBLANK_EVENT, 0))
+            print('  Sync objects:', caps.get(drm.Capability.SYNCOBJ, 0))
 
             if device.connectors:
                 print('connectors:')
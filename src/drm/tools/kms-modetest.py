@@ -82,11 +82,14 @@ def main():
             device = node.open()
 
             device.set_capability(drm.ClientCapability.UNIVERSAL_PLANES, True)
-            device.get_resources()
+            device.get_resources(lazy = True)
 
             if device.connectors:
                 for connector in device.connectors:
                     if connector.status == drm.Connector.Status.CONNECTED:
+                        if not connector.modes:
+                            connector.probe()
+
                         mode = connector.modes[0]
                         width = mode.hdisplay
                         height = mode.vdisplay